@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# Description: Benchmarks the decompressors on a synthetic corpus, compressed
+# 	with the reference encoders, and the block searches of the BRR encoder on
+# 	synthetic PCM data.  Results can be saved as JSON and compared with an
+# 	earlier run to catch performance regressions.
+
+import os, sys, time, json, platform, subprocess
+from cStringIO import StringIO
+import corpus, encoders, lz77, huf8, lzh8, romc, brrencode3
+
+MB = 1024 * 1024
+
+def decode_lz77(data):
+	return lz77.decompress(StringIO(data)).getvalue()
+
+def decode_huf8(data):
+	outfile = StringIO()
+	huf8.decompress(StringIO(data), outfile)
+	return outfile.getvalue()
+
+def decode_lzh8(data):
+	return lzh8.decompress(StringIO(data))
+
+def decode_romc(data):
+	return str(romc.decompress(StringIO(data)))
+
+# type 1 romc files hold a whole number of 4 MB units; fill the rest of the
+# last one the way ROMs are usually padded
+def pad_romc1(data):
+	return data + '\xff' * (-len(data) % encoders.ROMC_LZ77_UNIT)
+
+# name -> (encoder, decoder, function preparing the corpus for the codec)
+CODECS = {
+	'lz77-10': (lambda data: encoders.compress_lz77(data, 0x10), decode_lz77, None),
+	'lz77-11': (lambda data: encoders.compress_lz77(data, 0x11), decode_lz77, None),
+	'huf8': (encoders.compress_huf8, decode_huf8, None),
+	'lzh8': (encoders.compress_lzh8, decode_lzh8, None),
+	'romc1': (lambda data: encoders.compress_romc(data, 1), decode_romc, pad_romc1),
+	'romc2': (lambda data: encoders.compress_romc(data, 2), decode_romc, None),
+}
+CODEC_ORDER = ('lz77-10', 'lz77-11', 'huf8', 'lzh8', 'romc1', 'romc2')
+
+# file-like object that throws away what's written to it, to silence the
+# progress output of the decompressors
+class NullFile(object):
+	def write(self, data): pass
+	def flush(self): pass
+
+# Compresses data with a codec, then times the decompression.  The best of
+# repeat runs is kept.  Returns a dictionary of results.
+def run_codec(name, data, repeat=3):
+	encode, decode, prepare = CODECS[name]
+	if prepare: data = prepare(data)
+
+	start = time.time()
+	compressed = encode(data)
+	encode_time = time.time() - start
+
+	best = None
+	stdout = sys.stdout
+	try:
+		for i in xrange(repeat):
+			sys.stdout = NullFile()
+			start = time.time()
+			output = decode(compressed)
+			elapsed = time.time() - start
+			sys.stdout = stdout
+			if output != data: raise ValueError('%s decompression does not match the input' % name)
+			if best is None or elapsed < best: best = elapsed
+	finally:
+		sys.stdout = stdout
+
+	return {
+		'uncompressed': len(data),
+		'compressed': len(compressed),
+		'encode_seconds': round(encode_time, 4),
+		'decode_seconds': round(best, 4),
+		'decode_mb_per_second': round(len(data) / float(MB) / max(best, 1e-9), 3),
+	}
+
+# BRR block searches, in the order they are benchmarked; the first one is the
+# reference the others must match
+BRR_SEARCHES = [search for search in ('reference', 'python', 'numpy') if search in brrencode3.SEARCHES]
+
+# Encodes PCM data to BRR with each block search.  The best of repeat runs is
+# kept.  Returns a dictionary of results for each search.
+def run_brr(data, searches=BRR_SEARCHES, repeat=3):
+	blocks = len(data) / 32
+	results = {}
+	expected = None
+	for search in searches:
+		best = None
+		for i in xrange(repeat):
+			brr = StringIO()
+			start = time.time()
+			brrencode3.BRREncoder(StringIO(data), brr, search).encode()
+			elapsed = time.time() - start
+			if best is None or elapsed < best: best = elapsed
+		if expected is None: expected = brr.getvalue()
+		elif brr.getvalue() != expected:
+			raise ValueError('BRR encoding with the %s search does not match the %s search' % (search, searches[0]))
+		results[search] = {
+			'encode_seconds': round(best, 4),
+			'blocks_per_second': round(blocks / max(best, 1e-9), 1),
+		}
+	return results
+
+# returns the current git commit of the source tree, or None
+def git_commit():
+	try:
+		process = subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+			cwd=os.path.dirname(os.path.abspath(__file__)))
+		out = process.communicate()[0].strip()
+		if process.returncode == 0: return out
+	except OSError: pass
+	return None
+
+# Runs the benchmark for the given codecs, and the BRR benchmark on brr_blocks
+# blocks (none if 0).  Returns a dictionary ready to be saved as JSON.
+def run(codecs=CODEC_ORDER, size=MB, seed=0, repeat=3, brr_blocks=0, log=sys.stdout):
+	data = corpus.generate(size, seed)
+	report = {
+		'commit': git_commit(),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'corpus': {'size': size, 'seed': seed},
+		'repeat': repeat,
+		'results': {},
+	}
+	for name in codecs:
+		result = run_codec(name, data, repeat)
+		report['results'][name] = result
+		if log:
+			log.write('%-13s %9d -> %9d bytes  encode %7.2fs  decode %7.3fs  %8.2f MB/s\n' % (name,
+				result['uncompressed'], result['compressed'], result['encode_seconds'],
+				result['decode_seconds'], result['decode_mb_per_second']))
+			log.flush()
+	
+	if brr_blocks:
+		results = run_brr(corpus.pcm(brr_blocks * 16, seed), BRR_SEARCHES, repeat)
+		report['brr'] = {'blocks': brr_blocks, 'results': results}
+		if log:
+			for search in BRR_SEARCHES:
+				log.write('%-13s %6d blocks  encode %7.3fs  %8.1f blocks/s\n' % ('brr-' + search,
+					brr_blocks, results[search]['encode_seconds'], results[search]['blocks_per_second']))
+	return report
+
+# Compares decompression and BRR encoding speeds with an earlier report.
+# Returns the names of the codecs and BRR searches (as brr-<search>) that got
+# slower by more than threshold (a fraction).
+def compare(report, baseline, threshold=0.1, log=sys.stdout):
+	speeds = [] # (name, unit, old, new)
+	for name in CODEC_ORDER:
+		if name not in report['results'] or name not in baseline['results']: continue
+		speeds.append((name, 'MB/s', baseline['results'][name]['decode_mb_per_second'],
+			report['results'][name]['decode_mb_per_second']))
+	brr = report.get('brr', {}).get('results', {})
+	oldbrr = baseline.get('brr', {}).get('results', {})
+	for search in BRR_SEARCHES:
+		if search not in brr or search not in oldbrr: continue
+		speeds.append(('brr-' + search, 'blocks/s', oldbrr[search]['blocks_per_second'],
+			brr[search]['blocks_per_second']))
+	
+	regressions = []
+	for name, unit, old, new in speeds:
+		change = new / old - 1
+		slower = change < -threshold
+		if slower: regressions.append(name)
+		log.write('%-13s %8.2f -> %8.2f %-8s  %+6.1f%%%s\n' % (name, old, new, unit, change * 100,
+			slower and '  REGRESSION' or ''))
+	return regressions
+
+if __name__ == '__main__':
+	from optparse import OptionParser
+	parser = OptionParser(usage='%prog [options]')
+	parser.add_option('-s', '--size', type='int', default=MB,
+		help='corpus size in bytes (default: %default)')
+	parser.add_option('--seed', type='int', default=0,
+		help='corpus random seed (default: %default)')
+	parser.add_option('-r', '--repeat', type='int', default=3,
+		help='decompression runs per codec; the fastest is reported (default: %default)')
+	parser.add_option('-c', '--codec', action='append', choices=CODEC_ORDER,
+		help='codec to benchmark (%s); can be given more than once (default: all)' % ', '.join(CODEC_ORDER))
+	parser.add_option('-b', '--brr-blocks', type='int', default=1000,
+		help='PCM blocks to encode to BRR with each block search; 0 skips the BRR benchmark (default: %default)')
+	parser.add_option('-o', '--output', help='save the results as JSON to this file')
+	parser.add_option('--compare', help='compare with results saved by an earlier run')
+	parser.add_option('--threshold', type='float', default=10.0,
+		help='slowdown in percent counted as a regression by --compare (default: %default)')
+	options, args = parser.parse_args()
+
+	report = run(options.codec or CODEC_ORDER, options.size, options.seed, options.repeat, options.brr_blocks)
+
+	if options.output:
+		f = open(options.output, 'wb')
+		json.dump(report, f, indent=1, sort_keys=True, separators=(',', ': '))
+		f.close()
+
+	if options.compare:
+		f = open(options.compare, 'rb')
+		baseline = json.load(f)
+		f.close()
+		print
+		if compare(report, baseline, options.threshold / 100.0): sys.exit(1)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# Description: Bit readers over in-memory buffers, shared by the romchu, LZH8
+# 	and Huf8 decompressors.
+
+import struct
+
+# Reads bits starting with the least significant bit of each byte (romchu).
+# buf: string containing the bitstream
+# offset: byte offset of the first bit in buf
+# size: length of the bitstream in bits; defaults to the rest of buf
+class LSBBitReader(object):
+	def __init__(self, buf, offset=0, size=None):
+		if size is None: size = (len(buf) - offset) * 8
+		# pad with zeroes so that a refill never runs off the end
+		self.data = buf[offset:offset+(size+7)/8] + '\0' * 4
+		self.size = size
+		self.pos = 0 # byte offset of the next refill
+		self.reservoir = 0 # buffered bits, next bit in the LSB
+		self.count = 0 # number of bits in the reservoir
+		self.consumed = 0
+
+	# Adds 32 bits to the reservoir.  Reads are at most 32 bits, so refills
+	# only happen with fewer than 32 bits buffered, and the reservoir never
+	# grows past 63 bits (a native int rather than a long).
+	def refill(self):
+		# a word is only read while whole words remain, so the bits past the
+		# end of the stream are always the zero padding
+		if self.pos + 4 <= len(self.data):
+			self.reservoir |= struct.unpack_from('<I', self.data, self.pos)[0] << self.count
+			self.pos += 4
+		self.count += 32
+
+	# returns the next n bits (n <= 32) without consuming them
+	def peek(self, n):
+		if self.count < n: self.refill()
+		return self.reservoir & ((1 << n) - 1)
+
+	# consumes n bits that have already been peeked at
+	def consume(self, n):
+		self.reservoir >>= n
+		self.count -= n
+		self.consumed += n
+		if self.consumed > self.size:
+			raise ValueError("bitstream underflow")
+
+	# returns the next n bits (n <= 32), first bit in the LSB
+	def read(self, n):
+		if self.count < n: self.refill()
+		value = self.reservoir & ((1 << n) - 1)
+		self.reservoir >>= n
+		self.count -= n
+		self.consumed += n
+		if self.consumed > self.size:
+			raise ValueError("bitstream underflow")
+		return value
+
+	# Decodes one symbol through flat Huffman lookup tables, indexed by the
+	# next fast_bits bits.  Entries are (symbol << 5) | code length; an entry
+	# with a length of 0 holds the index of a (mask, table) pair in sub, whose
+	# table is indexed by the bits following the first fast_bits.  Unused
+	# entries are -1.
+	def decode(self, fast, sub, fast_bits):
+		if self.count < 32: self.refill()
+		entry = fast[self.reservoir & ((1 << fast_bits) - 1)]
+		# check for unused entries first: -1 has all of the length bits set
+		if entry < 0: raise ValueError("invalid Huffman code")
+		code_len = entry & 0x1F
+		if code_len == 0:
+			sub_mask, sub_table = sub[entry >> 5]
+			entry = sub_table[(self.reservoir >> fast_bits) & sub_mask]
+			if entry < 0: raise ValueError("invalid Huffman code")
+			code_len = entry & 0x1F
+		self.reservoir >>= code_len
+		self.count -= code_len
+		self.consumed += code_len
+		if self.consumed > self.size:
+			raise ValueError("bitstream underflow")
+		return entry >> 5
+
+	# returns the number of unread bits in the stream
+	def bits_left(self):
+		return self.size - self.consumed
+
+# Reads bits starting with the most significant bit of each storage unit.
+# The unit is a big-endian 32-bit word by default, which is the same as reading
+# each byte MSB first (LZH8); Huf8 uses little-endian 32-bit words ('<I').
+# buf, offset, size: see LSBBitReader
+class MSBBitReader(object):
+	def __init__(self, buf, offset=0, size=None, unit='>I'):
+		if size is None: size = (len(buf) - offset) * 8
+		self.unit = struct.Struct(unit)
+		self.unit_bits = self.unit.size * 8
+		self.data = buf[offset:offset+(size+7)/8] + '\0' * self.unit.size
+		self.size = size
+		self.pos = 0
+		self.reservoir = 0 # buffered bits, next bit in the MSB of the low count bits
+		self.count = 0
+		self.consumed = 0
+
+	# adds one unit to the reservoir (see LSBBitReader.refill)
+	def refill(self):
+		if self.pos + self.unit.size <= len(self.data):
+			self.reservoir = (self.reservoir << self.unit_bits) | self.unit.unpack_from(self.data, self.pos)[0]
+			self.pos += self.unit.size
+		else:
+			self.reservoir <<= self.unit_bits
+		self.count += self.unit_bits
+
+	# returns the next n bits (n <= 32) without consuming them
+	def peek(self, n):
+		if self.count < n: self.refill()
+		return self.reservoir >> (self.count - n)
+
+	# consumes n bits that have already been peeked at
+	def consume(self, n):
+		self.count -= n
+		self.reservoir &= (1 << self.count) - 1
+		self.consumed += n
+		if self.consumed > self.size:
+			raise ValueError("bitstream underflow")
+
+	# returns the next n bits (n <= 32), first bit in the MSB
+	def read(self, n):
+		if self.count < n: self.refill()
+		self.count -= n
+		value = self.reservoir >> self.count
+		self.reservoir &= (1 << self.count) - 1
+		self.consumed += n
+		if self.consumed > self.size:
+			raise ValueError("bitstream underflow")
+		return value
+
+	# returns the number of unread bits in the stream
+	def bits_left(self):
+		return self.size - self.consumed
+
+# Micro-benchmark: throughput of each reader in bits per second
+if __name__ == '__main__':
+	import os, time
+
+	data = os.urandom(1 << 20)
+	tests = [
+		('LSB read(1)', LSBBitReader, {}, 1),
+		('LSB read(9)', LSBBitReader, {}, 9),
+		('MSB read(1)', MSBBitReader, {}, 1),
+		('MSB read(9)', MSBBitReader, {}, 9),
+		('MSB <I read(1)', MSBBitReader, {'unit': '<I'}, 1),
+	]
+	for name, cls, kwargs, n in tests:
+		reader = cls(data, **kwargs)
+		reads = (len(data) * 8) / n
+		start = time.time()
+		read = reader.read
+		for i in xrange(reads): read(n)
+		elapsed = time.time() - start
+		print '%-16s %8.2f Mbit/s' % (name, reads * n / elapsed / 1e6)
@@ -6,9 +6,19 @@
 
 import wave
 import struct
+import sys
+from array import array
+from collections import OrderedDict
+
+try:
+	import numpy
+except ImportError:
+	numpy = None # search_numpy is not available
 
 class BRREncoder(object):
-	def __init__(self, pcm, brr):
+	# search: name of the function choosing the shift amount and filter of
+	# each block (see SEARCHES); DEFAULT_SEARCH if not given
+	def __init__(self, pcm, brr, search=None):
 		self.pcm_owner = False
 		self.brr_owner = False
 		
@@ -21,6 +31,7 @@ class BRREncoder(object):
 		
 		self.pcm = pcm
 		self.brr = brr
+		self.search = SEARCHES[search or DEFAULT_SEARCH]
 		self.p1 = 0
 		self.p2 = 0
 	
@@ -37,6 +48,12 @@ class BRREncoder(object):
 	
 	# void ADPCMBlockMash(short[] PCMData)
 	def ADPCMBlockMash(self, PCMData):
+		smin, kmin = self.search(self, PCMData)
+		self.BRRBuffer[0] = (smin<<4)|(kmin<<2)
+		self.ADPCMMash(smin, kmin, PCMData, True)
+	
+	# returns the shift amount and filter with the smallest error for a block
+	def ADPCMSearch(self, PCMData):
 		smin=0
 		kmin=0
 		dmin=2**31
@@ -51,8 +68,7 @@ class BRREncoder(object):
 				if dmin == 0.0: break
 			if dmin == 0.0: break
 		
-		self.BRRBuffer[0] = (smin<<4)|(kmin<<2)
-		self.ADPCMMash(smin, kmin, PCMData, True)
+		return smin, kmin
 	
 	# double ADPCMMash(int shiftamount, int filter, short[] PCMData, boolean write)
 	def ADPCMMash(self, shiftamount, filter, PCMData, write):
@@ -148,14 +164,189 @@ class BRREncoder(object):
 		if len(samples2) != 32:
 			raise ValueError('invalid PCM offset %d (file offset %d)' % (offset, offset*2))
 		
-		samples2 = struct.unpack('>16h', samples2)
-		
-		# encode to BRR
+		return self.encode_samples(struct.unpack('>16h', samples2))
+	
+	# PCMData: sequence of 16 samples
+	# returns: 9-byte BRR block
+	def encode_samples(self, PCMData):
 		self.BRRBuffer = [0, 0, 0, 0, 0, 0, 0, 0, 0]
-		self.ADPCMBlockMash(samples2)
-		
+		self.ADPCMBlockMash(PCMData)
 		return struct.pack('9B', *self.BRRBuffer)
+	
+	# Like encode_samples, but looks the block up in a BlockCache first
+	# PCMData: array('h') of 16 samples
+	def encode_cached(self, cache, PCMData):
+		key = (PCMData.tostring(), self.p1, self.p2)
+		entry = cache.get(key)
+		if entry is None:
+			block = self.encode_samples(PCMData)
+			cache.put(key, (block, self.p1, self.p2))
+		else:
+			block, self.p1, self.p2 = entry
+		return block
+
+# default number of blocks kept by a BlockCache
+DEFAULT_CACHE_SIZE = 0x10000
+
+# Remembers encoded BRR blocks.  A block only depends on its 16 samples and the
+# last two samples decoded before it, so sample data that is used more than
+# once, such as silence or a repeated loop, is searched only once.  At most
+# max_size blocks are kept, and the oldest are forgotten first.
+class BlockCache(object):
+	def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+		self.max_size = max_size
+		self.blocks = OrderedDict() # (samples, p1, p2) -> (block, p1, p2 after it)
+		self.hits = 0
+		self.misses = 0
+	
+	def get(self, key):
+		entry = self.blocks.get(key)
+		if entry is None: self.misses += 1
+		else: self.hits += 1
+		return entry
+	
+	def put(self, key, entry):
+		if len(self.blocks) >= self.max_size: self.blocks.popitem(False)
+		self.blocks[key] = entry
+
+# Reads a whole file of 16-bit big-endian PCM samples into an array('h'),
+# ignoring a trailing odd byte
+def read_pcm(pcm):
+	pcm.seek(0)
+	data = pcm.read()
+	samples = array('h', data[:len(data) & ~1])
+	if sys.byteorder == 'little': samples.byteswap()
+	return samples
+
+# The block searches below give the same result as BRREncoder.ADPCMSearch,
+# faster.  The squared errors of a block are integers below 2**37, so they are
+# exact both as doubles and as 64-bit integers, and equal errors are broken the
+# same way: the first candidate tried wins.
+
+# (shift amount, filter) pairs in the order ADPCMSearch tries them
+CANDIDATES = [(s, k) for s in range(13, 0, -1) for k in range(4)]
+
+# Returns the squared error of encoding a block with one shift amount and
+# filter, like ADPCMMash, but stops as soon as the error reaches limit.
+# l1, l2: the last two decoded samples before the block
+def mash_error(shiftamount, filter, PCMData, l1, l2, limit):
+	d2 = 0
+	vlin = 0
+	step = 1<<shiftamount
+	half = step>>1
+	offset = (step<<2) + (step>>2)
+	
+	for sample in PCMData:
+		if filter == 0:
+			pass
+		elif filter == 1:
+			vlin = (l1 >> 1) + ((-l1) >> 5)
+		elif filter == 2:
+			vlin = l1 + ((-(l1 + (l1>>1)))>>5) - (l2 >> 1) + (l2 >> 5)
+		else:
+			vlin = l1 + ((-(l1+(l1<<2) + (l1<<3)))>>7) - (l2>>1) + ((l2+(l2>>1))>>4)
+		
+		d = (sample>>1) - vlin
+		if 16384 < d < 32768 or -32768 < d < -16384:
+			d = d - 32768 * (d >> 24)
+		dp = d + offset
+		c = 0
+		if dp > 0:
+			c = dp / half
+			if c > 15: c = 15
+		dp = (c-8) << (shiftamount-1)
+		if shiftamount > 12:
+			dp = (dp >> 14) & ~0x7FF
+		
+		# clamp_16 and sshort
+		n = vlin + dp
+		if n > 0x7FFF: n = 0x7FFF - (n>>24)
+		n *= 2
+		if n > 0x7FFF: n -= 0x10000
+		elif n < -0x8000: n &= 0x7FFF
+		
+		l2 = l1
+		l1 = n
+		d = sample - n
+		d2 += d*d
+		if d2 >= limit: break
+	
+	return d2
+
+# Searches a block in pure Python, skipping the rest of a candidate once its
+# error can no longer beat the best one so far.
+def search_python(encoder, PCMData):
+	smin = 0
+	kmin = 0
+	dmin = 2**31
+	p1 = encoder.p1
+	p2 = encoder.p2
+	
+	for s, k in CANDIDATES:
+		d = mash_error(s, k, PCMData, p1, p2, dmin)
+		if d < dmin:
+			smin = s
+			kmin = k
+			dmin = d
+			if dmin == 0: break
+	
+	return smin, kmin
+
+# Searches a block with NumPy, encoding it with all candidates at once, one
+# sample at a time.  The arrays are so small that the cost of each NumPy call
+# dominates, so this is slower than search_python; see benchmark.py --brr.
+def search_numpy(encoder, PCMData):
+	n = len(CANDIDATES)
+	l1 = numpy.empty(n, numpy.int64)
+	l1.fill(encoder.p1)
+	l2 = numpy.empty(n, numpy.int64)
+	l2.fill(encoder.p2)
+	d2 = numpy.zeros(n, numpy.int64)
+	
+	for sample in PCMData:
+		v1 = (l1 >> 1) + ((-l1) >> 5)
+		v2 = l1 + ((-(l1 + (l1>>1)))>>5) - (l2 >> 1) + (l2 >> 5)
+		v3 = l1 + ((-(l1+(l1<<2) + (l1<<3)))>>7) - (l2>>1) + ((l2+(l2>>1))>>4)
+		vlin = numpy.choose(NUMPY_FILTERS, (0, v1, v2, v3))
+		
+		d = (sample>>1) - vlin
+		da = numpy.abs(d)
+		d = numpy.where((da > 16384) & (da < 32768), d - 32768 * (d >> 24), d)
+		dp = d + NUMPY_OFFSETS
+		c = numpy.where(dp > 0, numpy.minimum(dp // NUMPY_HALF_STEPS, 15), 0)
+		dp = (c-8) << NUMPY_SHIFTS_1
+		dp = numpy.where(NUMPY_BIG_SHIFTS, (dp >> 14) & ~0x7FF, dp)
+		
+		# clamp_16 and sshort
+		m = vlin + dp
+		m = numpy.where(m > 0x7FFF, 0x7FFF - (m>>24), m) * 2
+		m = numpy.where(m > 0x7FFF, m - 0x10000, numpy.where(m < -0x8000, m & 0x7FFF, m))
+		
+		l2 = l1
+		l1 = m
+		d = sample - m
+		d2 += d*d
+	
+	# argmin picks the first of equal errors
+	best = int(d2.argmin())
+	if d2[best] >= 2**31: return 0, 0
+	return CANDIDATES[best]
+
+if numpy is not None:
+	NUMPY_SHIFTS_1 = numpy.array([s - 1 for s, k in CANDIDATES], numpy.int64)
+	NUMPY_FILTERS = numpy.array([k for s, k in CANDIDATES], numpy.int64)
+	NUMPY_HALF_STEPS = numpy.array([(1<<s)>>1 for s, k in CANDIDATES], numpy.int64)
+	NUMPY_OFFSETS = numpy.array([((1<<s)<<2) + ((1<<s)>>2) for s, k in CANDIDATES], numpy.int64)
+	NUMPY_BIG_SHIFTS = numpy.array([s > 12 for s, k in CANDIDATES])
+
+# name -> function returning the (shift amount, filter) of a block
+SEARCHES = {
+	'reference': BRREncoder.ADPCMSearch.im_func,
+	'python': search_python,
+}
+if numpy is not None: SEARCHES['numpy'] = search_numpy
 
+DEFAULT_SEARCH = 'python'
 
 if __name__ == '__main__':
 	import sys
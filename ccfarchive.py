@@ -3,9 +3,14 @@
 # Date: December 27, 2010
 # Description: Reads Wii CCF archives, which contain Genesis and Master System ROMs.
 
+import os
 import struct
 import zlib
 from cStringIO import StringIO
+import decompcache, timing
+
+# size of the pieces members are read and decompressed in when streamed
+CHUNK_SIZE = 64 * 1024
 
 class CCFArchive(object):
 	# archive: a file-like object containing the CCF archive, OR the path to a CCF archive
@@ -15,7 +20,11 @@ class CCFArchive(object):
 		else:
 			self.file = archive
 		self.files = []
-		self.readheader()
+		self.names = {} # file name -> FileDescriptor (the last one, if several have the name)
+		self.trie = TrieNode() # file names without trailing whitespace -> position in self.files
+		with timing.stage('open CCF archive') as stage:
+			self.readheader()
+			stage.bytes_in = 32 + 32 * len(self.files)
 	
 	def readheader(self):
 		magic, zeroes1, rootnode_offset, numfiles, zeroes2 = struct.unpack('<4s12sII8s', self.file.read(32))
@@ -25,33 +34,144 @@ class CCFArchive(object):
 		assert zeroes2 == 8 * '\0'
 		for i in range(numfiles):
 			fd = FileDescriptor(self.file)
+			self.names[fd.name] = fd
+			self.trie.add(fd.name.rstrip(), len(self.files))
 			self.files.append(fd)
 	
 	def hasfile(self, path):
-		for f in self.files:
-			if f.name == path: return True
-		return False
+		return path in self.names
 	
 	def getfile(self, path):
 		assert self.hasfile(path)
-		fd = None
-		for f in self.files:
-			if f.name == path: fd = f
-		return self.getfile2(fd)
+		return self.getfile2(self.names[path])
 	
 	def getfile2(self, fd):
 		self.file.seek(fd.data_offset * 32)
 		string = self.file.read(fd.size)
 		if fd.compressed:
-			string = zlib.decompress(string)
+			string = decompcache.cached('zlib', string, lambda: zlib.decompress(string))
 			assert len(string) == fd.decompressed_size
 		return StringIO(string)
 	
+	# Generator yielding the contents of a file in pieces of up to about
+	# chunk_size bytes, decompressing it as it goes
+	def readchunks(self, fd, chunk_size=CHUNK_SIZE):
+		member = MemberFile(self.file, fd.data_offset * 32, fd.size)
+		if not fd.compressed:
+			while True:
+				data = member.read(chunk_size)
+				if not data: break
+				yield data
+			return
+		
+		decompressor = zlib.decompressobj()
+		size = 0
+		while True:
+			data = member.read(chunk_size)
+			if not data: break
+			# limit the output of each step; the input that wasn't used yet is
+			# left in unconsumed_tail
+			while data:
+				out = decompressor.decompress(data, chunk_size)
+				data = decompressor.unconsumed_tail
+				if out:
+					size += len(out)
+					yield out
+		data = decompressor.flush()
+		size += len(data)
+		if data: yield data
+		assert size == fd.decompressed_size
+	
+	# Writes the contents of a file to the file-like object outfile, a piece at
+	# a time, so the file is never held in memory whole.  Compressed files go
+	# through the decompression cache, if one is configured.
+	# Returns the number of bytes written.
+	def extractfile(self, fd, outfile):
+		if fd.compressed:
+			member = MemberFile(self.file, fd.data_offset * 32, fd.size)
+			return decompcache.decompress_to('zlib', member, outfile, lambda infile, out: self.writechunks(fd, out))
+		return self.writechunks(fd, outfile)
+	
+	# writes the pieces from readchunks() to outfile; returns the number of bytes
+	def writechunks(self, fd, outfile):
+		size = 0
+		for data in self.readchunks(fd):
+			outfile.write(data)
+			size += len(data)
+		return size
+	
+	# Returns the descriptor of the requested file, even if the name is cut off
+	# inside the archive, or the name asked for is cut off: the first file whose
+	# name starts with name, or that name starts with.
+	def finddescriptor(self, name):
+		position = self.trie.find(name, name.rstrip())
+		if position is None: return None
+		return self.files[position]
+	
 	# returns the requested file, even if the name is cut off inside the archive
 	def find(self, name):
-		for fd in self.files:
-			if name.startswith(fd.name.rstrip()) or fd.name.startswith(name.rstrip()): return self.getfile2(fd)
-		return None
+		fd = self.finddescriptor(name)
+		if fd is None: return None
+		return self.getfile2(fd)
+
+# Read-only file-like object for a region of another file, such as the raw data
+# of a CCF member
+class MemberFile(object):
+	def __init__(self, f, offset, size):
+		self.file = f
+		self.offset = offset
+		self.size = size
+		self.pos = 0
+	
+	def read(self, size=-1):
+		if size < 0 or size > self.size - self.pos: size = self.size - self.pos
+		if size <= 0: return ''
+		self.file.seek(self.offset + self.pos)
+		data = self.file.read(size)
+		self.pos += len(data)
+		return data
+	
+	def seek(self, offset, whence=os.SEEK_SET):
+		if whence == os.SEEK_CUR: offset += self.pos
+		elif whence == os.SEEK_END: offset += self.size
+		self.pos = max(0, offset)
+	
+	def tell(self):
+		return self.pos
+
+# Prefix tree of file names, for finding the first file (by position) whose
+# name is a prefix of a given name, or starts with a given prefix
+class TrieNode(object):
+	__slots__ = ('children', 'end', 'first')
+	
+	def __init__(self):
+		self.children = {} # character -> TrieNode
+		self.end = None # first position of a name ending here
+		self.first = None # first position of a name ending here or below
+	
+	# adds a name; positions must be added in increasing order
+	def add(self, name, position):
+		node = self
+		if node.first is None: node.first = position
+		for c in name:
+			node = node.children.setdefault(c, TrieNode())
+			if node.first is None: node.first = position
+		if node.end is None: node.end = position
+	
+	# Returns the first position of a name that name starts with, or that
+	# starts with prefix, or None.  prefix must be a prefix of name.
+	def find(self, name, prefix):
+		best = None
+		node = self
+		depth = 0
+		while True:
+			if node.end is not None and (best is None or node.end < best): best = node.end
+			if depth == len(prefix) and node.first is not None and (best is None or node.first < best): best = node.first
+			if depth == len(name): break
+			node = node.children.get(name[depth])
+			if node is None: break
+			depth += 1
+		return best
 
 class FileDescriptor(object):
 	# f: a file-like object of a CCF file at the position of this file descriptor
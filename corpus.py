@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# Description: Generates synthetic ROM-like data for testing and benchmarking
+# 	the decompressors without real NAND dumps.  The output is deterministic
+# 	for a given size and seed.
+
+import random, struct, math
+
+# MIPS-like machine code: big-endian instruction words built from a small set
+# of opcodes, registers and immediates, with the occasional function prologue
+def code_section(rand, size):
+	prologue = struct.pack('>IIII', 0x27bdffe8, 0xafbf0014, 0xafb00010, 0x00808021)
+	epilogue = struct.pack('>IIII', 0x8fbf0014, 0x8fb00010, 0x03e00008, 0x27bd0018)
+	opcodes = (0x09, 0x0f, 0x23, 0x2b, 0x24, 0x0c, 0x04, 0x05, 0x00)
+	out = []
+	length = 0
+	while length < size:
+		if rand.random() < 0.05:
+			words = prologue
+		elif rand.random() < 0.05:
+			words = epilogue
+		else:
+			opcode = rand.choice(opcodes)
+			rs = rand.choice((2, 3, 4, 5, 16, 17, 29, 31))
+			rt = rand.choice((2, 3, 4, 5, 6, 16, 17))
+			if opcode == 0x00: # register-register arithmetic
+				word = (rs << 21) | (rt << 16) | (rand.choice((2, 3, 8, 9)) << 11) | rand.choice((0x21, 0x23, 0x24, 0x25, 0x2a))
+			elif opcode == 0x0c: # jal to one of a few functions
+				word = (opcode << 26) | (0x80000 + rand.randrange(64) * 0x40)
+			else:
+				word = (opcode << 26) | (rs << 21) | (rt << 16) | (rand.randrange(64) * rand.choice((1, 4, 8)) & 0xffff)
+			words = struct.pack('>I', word)
+		out.append(words)
+		length += len(words)
+	return ''.join(out)[:size]
+
+# 8x8 4-bit planar tiles with a few colors each; many repeat, and some are blank
+def tiles_section(rand, size):
+	tiles = ['\0' * 32]
+	out = []
+	length = 0
+	while length < size:
+		if rand.random() < 0.4:
+			tile = rand.choice(tiles)
+		else:
+			colors = [rand.randrange(16) for i in xrange(rand.randrange(2, 5))]
+			rows = []
+			row = [rand.choice(colors) for i in xrange(8)]
+			for y in xrange(8):
+				# rows often repeat, and change a pixel or two when they don't
+				if rand.random() < 0.5:
+					row = list(row)
+					row[rand.randrange(8)] = rand.choice(colors)
+				rows.append(row)
+			planes = ''
+			for plane in xrange(4):
+				for row in rows:
+					byte = 0
+					for pixel in row: byte = (byte << 1) | ((pixel >> plane) & 1)
+					planes += chr(byte)
+			tile = planes
+			tiles.append(tile)
+		out.append(tile)
+		length += len(tile)
+	return ''.join(out)[:size]
+
+WORDS = ('the', 'a', 'you', 'to', 'of', 'and', 'is', 'press', 'start', 'button',
+	'game', 'over', 'continue', 'level', 'world', 'player', 'score', 'time',
+	'castle', 'princess', 'key', 'door', 'found', 'item', 'power', 'up', 'use',
+	'attack', 'jump', 'enemy', 'boss', 'stage', 'clear', 'bonus', 'lives')
+
+# game text: sentences made of common words, each ending in a control code
+def text_section(rand, size):
+	out = []
+	length = 0
+	while length < size:
+		words = [rand.choice(WORDS) for i in xrange(rand.randrange(3, 12))]
+		sentence = ' '.join(words).capitalize() + rand.choice(('.', '!', '?', '...'))
+		if rand.random() < 0.3: sentence = sentence.upper()
+		sentence += rand.choice(('\n', '\x01', '\xff'))
+		out.append(sentence)
+		length += len(sentence)
+	return ''.join(out)[:size]
+
+# pointer tables and level data: big-endian addresses with small increments,
+# and rows of map tiles with long runs
+def table_section(rand, size):
+	out = []
+	length = 0
+	address = 0x80100000 + rand.randrange(0x1000) * 0x10
+	while length < size:
+		if rand.random() < 0.5:
+			entries = []
+			for i in xrange(rand.randrange(4, 64)):
+				address += rand.choice((4, 8, 0x10, 0x20, 0x40))
+				entries.append(struct.pack('>I', address & 0xffffffff))
+			chunk = ''.join(entries)
+		else:
+			chunk = ''
+			for i in xrange(rand.randrange(1, 8)):
+				tile = rand.randrange(256)
+				chunk += chr(tile) * rand.randrange(1, 32)
+		out.append(chunk)
+		length += len(chunk)
+	return ''.join(out)[:size]
+
+# unused space, filled with 0x00 or 0xff
+def padding_section(rand, size):
+	return rand.choice(('\0', '\xff')) * size
+
+# already compressed or noisy data, such as audio samples
+def noise_section(rand, size):
+	return ''.join(chr(rand.getrandbits(8)) for i in xrange(size))
+
+# section generators and their share of the output
+SECTIONS = (
+	(code_section, 0.35),
+	(tiles_section, 0.25),
+	(text_section, 0.15),
+	(table_section, 0.15),
+	(padding_section, 0.05),
+	(noise_section, 0.05),
+)
+
+# Returns size bytes of ROM-like data, made of sections of machine code, tiles,
+# text, tables, padding and noise of 1-16 KB each.
+def generate(size, seed=0):
+	rand = random.Random(seed)
+	out = []
+	length = 0
+	while length < size:
+		pick = rand.random()
+		for section, share in SECTIONS:
+			pick -= share
+			if pick < 0: break
+		chunk = section(rand, min(size - length, rand.randrange(0x400, 0x4000)))
+		out.append(chunk)
+		length += len(chunk)
+	return ''.join(out)
+
+# Returns count 16-bit big-endian samples of audio-like PCM data, as found in
+# the PCM files of SNES titles: notes made of a few decaying harmonics, with
+# some noise, silence and clipped loud passages.
+def pcm(count, seed=0):
+	rand = random.Random(seed)
+	out = []
+	while len(out) < count:
+		length = rand.randrange(0x200, 0x2000)
+		if rand.random() < 0.1:
+			out.extend([0] * length)
+			continue
+		period = rand.uniform(8, 200)
+		volume = rand.uniform(2000, 40000) # past 32767 clips
+		harmonics = [(h, rand.uniform(0, 1.0 / h)) for h in xrange(1, rand.randrange(2, 6))]
+		noise = rand.choice((0, 50, 500, 4000))
+		decay = rand.uniform(0.0001, 0.002)
+		for i in xrange(length):
+			value = sum(level * math.sin(2 * math.pi * h * i / period) for h, level in harmonics)
+			value = volume * math.exp(-decay * i) * value
+			if noise: value += rand.gauss(0, noise)
+			value = int(value)
+			out.append(max(-0x8000, min(0x7fff, value)))
+	return struct.pack('>%dh' % count, *out[:count])
+
+if __name__ == '__main__':
+	import sys
+	if len(sys.argv) not in (3, 4):
+		sys.stderr.write('Usage: %s size outfile [seed]\n' % sys.argv[0])
+		sys.exit(1)
+
+	seed = 0
+	if len(sys.argv) == 4: seed = int(sys.argv[3])
+	outfile = open(sys.argv[2], 'wb')
+	outfile.write(generate(int(sys.argv[1]), seed))
+	outfile.close()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# Description: On-disk cache of decompressed files, keyed by a hash of the
+# 	compressed data and the compression type, shared between runs and NAND dumps.
+
+import os, os.path, hashlib, shutil, tempfile
+import timing
+
+# bump this when a decompressor changes its output, to ignore old entries
+CACHE_VERSION = 1
+
+# default cache location and size limit used by wiimetadata.py
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'vcromclaim')
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+# eviction shrinks the cache to this fraction of its size limit, so a full
+# cache isn't scanned again for every new entry
+EVICT_TARGET = 0.9
+
+class DecompressionCache(object):
+	# path: cache directory; it's created if it doesn't exist
+	# max_size: limit on the total size of the entries in bytes; the least
+	# recently used entries are removed first
+	def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+		self.path = path
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self.size = None # running total size of the entries; None until scanned
+		if not os.path.isdir(path): os.makedirs(path)
+
+	# returns the key for data compressed with the given codec ('lz77', 'romc', ...)
+	def key(self, codec, data):
+		h = hashlib.sha1('%s:%d:' % (codec, CACHE_VERSION))
+		h.update(data)
+		return h.hexdigest()
+
+	# Like key(), but for the contents of the file-like object infile, which
+	# is read a piece at a time and left at the start
+	def filekey(self, codec, infile):
+		h = hashlib.sha1('%s:%d:' % (codec, CACHE_VERSION))
+		infile.seek(0)
+		while True:
+			data = infile.read(1024 * 1024)
+			if not data: break
+			h.update(data)
+		infile.seek(0)
+		return h.hexdigest()
+
+	def entrypath(self, key):
+		return os.path.join(self.path, key[:2], key)
+
+	# Returns an open file for a cached entry, or None if there isn't one.
+	# Opening an entry marks it as recently used.
+	def open(self, key):
+		path = self.entrypath(key)
+		try:
+			f = open(path, 'rb')
+		except IOError:
+			self.misses += 1
+			return None
+		self.hits += 1
+		try: os.utime(path, None)
+		except OSError: pass
+		return f
+
+	# returns the contents of a cached entry, or None if there isn't one
+	def get(self, key):
+		f = self.open(key)
+		if not f: return None
+		data = f.read()
+		f.close()
+		return data
+
+	# stores data (a string or bytearray) as the entry for key
+	def put(self, key, data):
+		if len(data) > self.max_size: return
+		writer = self.create(key)
+		try:
+			writer.write(data)
+		except:
+			writer.abort()
+			raise
+		writer.commit()
+
+	# Returns a CacheWriter for a new entry, which becomes visible only once
+	# it's committed.  Everything written is also written to copy_to, if given.
+	def create(self, key, copy_to=None):
+		return CacheWriter(self, key, copy_to)
+
+	# Adds a committed entry of the given size to the running total, and evicts
+	# entries if the cache has grown past max_size.  The directory is only
+	# scanned the first time and when evicting, not on every entry.
+	# replaced: size of the entry the new one replaced, if any
+	def added(self, size, replaced=0):
+		if self.size is None: self.size = self.scan()[1]
+		else: self.size += size - replaced
+		if self.size > self.max_size: self.evict()
+
+	# returns a list of (mtime, path, size) for the entries, and their total size
+	def scan(self):
+		entries = []
+		total = 0
+		for subdir in os.listdir(self.path):
+			subdir = os.path.join(self.path, subdir)
+			if not os.path.isdir(subdir): continue
+			for name in os.listdir(subdir):
+				path = os.path.join(subdir, name)
+				try: st = os.stat(path)
+				except OSError: continue
+				entries.append((st.st_mtime, path, st.st_size))
+				total += st.st_size
+		return entries, total
+
+	# Removes the least recently used entries until the cache is down to
+	# EVICT_TARGET of max_size.  The directory is scanned again, since other
+	# processes may share it.
+	def evict(self):
+		entries, total = self.scan()
+		if total <= self.max_size:
+			self.size = total
+			return
+		entries.sort()
+		for mtime, path, size in entries:
+			if total <= self.max_size * EVICT_TARGET: break
+			try: os.remove(path)
+			except OSError: continue
+			total -= size
+		self.size = total
+
+# Writes a cache entry to a temporary file, which is renamed to the entry's
+# name on commit() so that readers never see a partial entry.
+class CacheWriter(object):
+	def __init__(self, cache, key, copy_to=None):
+		self.cache = cache
+		self.path = cache.entrypath(key)
+		self.copy_to = copy_to
+		self.size = 0
+		fd, self.tmppath = tempfile.mkstemp(prefix='tmp-', dir=cache.path)
+		self.file = os.fdopen(fd, 'wb')
+
+	def write(self, data):
+		if self.copy_to: self.copy_to.write(data)
+		if not self.file: return
+		self.size += len(data)
+		if self.size > self.cache.max_size:
+			# too big to cache; keep passing the data through to copy_to
+			self.abort()
+		else:
+			self.file.write(data)
+
+	def commit(self):
+		if not self.file: return
+		self.file.close()
+		self.file = None
+		subdir = os.path.dirname(self.path)
+		if not os.path.isdir(subdir):
+			try: os.makedirs(subdir)
+			except OSError: pass # created by another process in the meantime
+		replaced = 0
+		if os.path.exists(self.path):
+			replaced = os.path.getsize(self.path)
+			if os.name == 'nt': os.remove(self.path)
+		os.rename(self.tmppath, self.path)
+		self.cache.added(self.size, replaced)
+
+	def abort(self):
+		if not self.file: return
+		self.file.close()
+		self.file = None
+		os.remove(self.tmppath)
+
+# the cache consulted by the decompressors, or None to bypass it
+cache = None
+
+# Sets up the cache used by the decompressors.  path=None disables it.
+def configure(path, max_size=DEFAULT_MAX_SIZE):
+	global cache
+	if path is None: cache = None
+	else: cache = DecompressionCache(path, max_size)
+
+# Returns the decompressed contents of the string data, using the cache if one
+# is configured.  decode() does the actual decompression and returns a string or
+# bytearray; cached entries are returned as strings.
+def cached(codec, data, decode):
+	with timing.stage('decompress ' + codec, len(data)) as stage:
+		if cache is None:
+			result = decode()
+		else:
+			key = cache.key(codec, data)
+			result = cache.get(key)
+			if result is None:
+				result = decode()
+				cache.put(key, result)
+			else: stage.info['cached'] = True
+		stage.bytes_out = len(result)
+	return result
+
+# returns the size of a file-like object, leaving it at the start
+def file_size(f):
+	f.seek(0, os.SEEK_END)
+	size = f.tell()
+	f.seek(0)
+	return size
+
+# Like cached(), but for the contents of the file-like object infile, which is
+# only read for hashing if a cache is configured.  decode(infile) does the
+# actual decompression.
+def decompress(codec, infile, decode):
+	if cache is None:
+		with timing.stage('decompress ' + codec, file_size(infile)) as stage:
+			result = decode(infile)
+			stage.bytes_out = len(result)
+		return result
+
+	infile.seek(0)
+	data = infile.read()
+	infile.seek(0)
+	return cached(codec, data, lambda: decode(infile))
+
+# Like decompress(), but writes the decompressed contents of infile to outfile.
+# decode(infile, outfile) does the actual decompression and returns the number
+# of bytes written, which is also returned by this function.
+def decompress_to(codec, infile, outfile, decode):
+	with timing.stage('decompress ' + codec, file_size(infile)) as stage:
+		if cache is None:
+			size = decode(infile, outfile)
+		else:
+			key = cache.filekey(codec, infile)
+			entry = cache.open(key)
+			if entry:
+				shutil.copyfileobj(entry, outfile)
+				size = entry.tell()
+				entry.close()
+				stage.info['cached'] = True
+			else:
+				writer = cache.create(key, outfile)
+				try:
+					size = decode(infile, writer)
+				except:
+					writer.abort()
+					raise
+				writer.commit()
+		stage.bytes_out = size
+	return size
@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+# Description: Reference encoders for the compression formats used in Virtual
+# 	Console games (LZ77 type 0x10/0x11, Huf8, LZH8, and romc types 1 and 2).
+# 	They make no attempt to match Nintendo's compression ratios; they exist
+# 	to produce test and benchmark input for the decompressors.
+
+import struct, heapq
+
+# Finds LZ77 matches in data[start:end].  Returns a list of tokens, each either
+# a byte value (literal) or a (length, displacement) tuple.  Matches may reach
+# up to window bytes back, including before start.
+def tokenize(data, start, end, window, max_length, min_length=3):
+	tokens = []
+	chains = {} # 3-byte prefix -> recent positions starting with it
+
+	def insert(pos):
+		key = data[pos:pos+3]
+		chain = chains.get(key)
+		if chain is None: chains[key] = [pos]
+		else:
+			chain.append(pos)
+			if len(chain) > 32: del chain[:-16]
+
+	for pos in xrange(max(0, start - window), start): insert(pos)
+
+	pos = start
+	while pos < end:
+		best_length = 0
+		best_disp = 0
+		limit = min(max_length, end - pos)
+		for candidate in reversed(chains.get(data[pos:pos+3], ())[-16:]):
+			if pos - candidate > window: break
+			# skip candidates that can't beat the best match so far
+			if best_length and (best_length >= limit or data[candidate+best_length] != data[pos+best_length]): continue
+			length = 0
+			while length < limit and data[candidate+length] == data[pos+length]: length += 1
+			if length > best_length:
+				best_length = length
+				best_disp = pos - candidate
+				if length == limit: break
+
+		if best_length >= min_length:
+			tokens.append((best_length, best_disp))
+			for i in xrange(pos, pos + best_length): insert(i)
+			pos += best_length
+		else:
+			tokens.append(ord(data[pos]))
+			insert(pos)
+			pos += 1
+	return tokens
+
+# Writes a bitstream starting with the least significant bit of each byte (romchu).
+class LSBBitWriter(object):
+	def __init__(self):
+		self.out = bytearray()
+		self.acc = 0
+		self.count = 0
+		self.bits = 0 # total number of bits written
+
+	# writes the n low bits of value, least significant bit first
+	def write(self, value, n):
+		self.acc |= (value & ((1 << n) - 1)) << self.count
+		self.count += n
+		self.bits += n
+		while self.count >= 8:
+			self.out.append(self.acc & 0xff)
+			self.acc >>= 8
+			self.count -= 8
+
+	# writes an n-bit Huffman code, most significant bit first
+	def writecode(self, code, n):
+		reversed_code = 0
+		for i in xrange(n):
+			reversed_code = (reversed_code << 1) | ((code >> i) & 1)
+		self.write(reversed_code, n)
+
+	# returns the bitstream, padded with zeroes to a whole number of bytes
+	def getvalue(self):
+		if self.count: return str(self.out) + chr(self.acc)
+		return str(self.out)
+
+# Writes a bitstream starting with the most significant bit of each byte (LZH8, Huf8).
+class MSBBitWriter(object):
+	def __init__(self):
+		self.out = bytearray()
+		self.acc = 0
+		self.count = 0
+
+	# writes the n low bits of value, most significant bit first
+	def write(self, value, n):
+		self.acc = (self.acc << n) | (value & ((1 << n) - 1))
+		self.count += n
+		while self.count >= 8:
+			self.count -= 8
+			self.out.append((self.acc >> self.count) & 0xff)
+		self.acc &= (1 << self.count) - 1
+
+	# returns the bitstream, padded with zeroes to a multiple of align bytes
+	def getvalue(self, align=1):
+		out = bytearray(self.out)
+		if self.count: out.append((self.acc << (8 - self.count)) & 0xff)
+		out += '\0' * (-len(out) % align)
+		return str(out)
+
+# Builds a Huffman tree from a dictionary of symbol frequencies.  Leaves are
+# symbols; internal nodes are (left, right) tuples.  The tree always has at
+# least two leaves, so every symbol has a code of at least one bit.
+def huffman_tree(freqs):
+	heap = [(freq, i, symbol) for i, (symbol, freq) in enumerate(sorted(freqs.items()))]
+	if len(heap) == 1: heap.append((0, -1, heap[0][2]))
+	heapq.heapify(heap)
+	order = len(heap)
+	while len(heap) > 1:
+		a = heapq.heappop(heap)
+		b = heapq.heappop(heap)
+		heapq.heappush(heap, (a[0] + b[0], order, (a[2], b[2])))
+		order += 1
+	return heap[0][2]
+
+# Lays out a Huffman tree as the node table used by Huf8 and LZH8: the root,
+# followed by the children of the internal nodes in pairs.  Each internal node
+# stores the offset of its children's pair relative to its own pair, which can
+# be at most max_offset.
+#
+# Placing the pairs breadth-first overflows the offset on flat trees, so the
+# pair of the internal node with the smallest subtree is placed next, unless
+# that would leave a waiting node unable to reach its children; then the node
+# that has been waiting longest goes first.
+#
+# Returns (entries, codes).  entries[0] is the root; the children of pair m
+# (from 1) are entries[2*m-1] and entries[2*m].  Leaf entries are symbols;
+# internal entries are (offset, left is a leaf, right is a leaf).  codes maps
+# each symbol to a (code, length) tuple; a symbol with more than one leaf gets
+# the code of the first one placed.
+def layout_tree(tree, max_offset):
+	window = max_offset + 1
+	sizes = {}
+	def subtree_size(node):
+		if type(node) != tuple: return 1
+		if id(node) not in sizes:
+			sizes[id(node)] = subtree_size(node[0]) + subtree_size(node[1])
+		return sizes[id(node)]
+
+	entries = [None]
+	codes = {}
+	# (last pair its children can go in, entry index, node, code, code length)
+	pending = [(window, 0, tree, 0, 0)]
+	pair = 1
+	while pending:
+		pending.sort()
+		choice = min(xrange(len(pending)), key=lambda i: (subtree_size(pending[i][2]), pending[i][0]))
+		# placing choice first must leave room for the others, in deadline order
+		slot = pair + 1
+		for i, item in enumerate(pending):
+			if i == choice: continue
+			if slot > item[0]:
+				choice = 0
+				break
+			slot += 1
+
+		deadline, index, node, code, length = pending.pop(choice)
+		if pair > deadline: raise ValueError('Huffman tree cannot be laid out')
+		entries[index] = (pair - (deadline - window) - 1, type(node[0]) != tuple, type(node[1]) != tuple)
+		for side, child in enumerate(node):
+			child_index = len(entries)
+			entries.append(child)
+			child_code = (code << 1) | side
+			if type(child) == tuple: pending.append((pair + window, child_index, child, child_code, length + 1))
+			else: codes.setdefault(child, (child_code, length + 1))
+		pair += 1
+
+	return entries, codes
+
+# Returns the number of bits in the binary representation of n
+def bit_length(n):
+	length = 0
+	while n:
+		n >>= 1
+		length += 1
+	return length
+
+# Returns the header of a compressed file: the compression type and the 24-bit
+# decompressed size.  A size of 0 means the real size follows as 32 bits, which
+# only the formats with extended set can hold; it's used for sizes that don't
+# fit in 24 bits, and for empty data, which would otherwise read as extended.
+def size_header(size, compression_type, extended=False):
+	if 0 < size < 1 << 24: return struct.pack('<I', (size << 8) | compression_type)
+	elif not extended:
+		raise ValueError('data size %d is out of range for compression type 0x%02x (1 to %d bytes)' %
+			(size, compression_type, (1 << 24) - 1))
+	elif size >= 1 << 32:
+		raise ValueError('data size %d is out of range for compression type 0x%02x' % (size, compression_type))
+	return struct.pack('<II', compression_type, size)
+
+# Compresses data (a string) with Nintendo's LZ77 variants; compression_type is
+# 0x10 or 0x11
+def compress_lz77(data, compression_type=0x10):
+	if compression_type == 0x10: max_length = 18
+	elif compression_type == 0x11: max_length = 0x10110
+	else: raise ValueError('unsupported LZ77 type 0x%02x' % compression_type)
+	return size_header(len(data), compression_type, compression_type == 0x11) + lz77_body(data, compression_type, max_length)
+
+# The LZ77 stream after the header: groups of 8 tokens, each preceded by a byte
+# of flags, with the first token in the most significant bit
+def lz77_body(data, compression_type, max_length):
+	tokens = tokenize(data, 0, len(data), 0x1000, max_length)
+	out = bytearray()
+	for group in xrange(0, len(tokens), 8):
+		flags_pos = len(out)
+		flags = 0
+		out.append(0)
+		for i, token in enumerate(tokens[group:group+8]):
+			if type(token) != tuple:
+				out.append(token)
+				continue
+			flags |= 0x80 >> i
+			length, disp = token
+			disp -= 1
+			if compression_type == 0x10:
+				out += struct.pack('>H', ((length - 3) << 12) | disp)
+			elif length <= 0x10:
+				out += struct.pack('>H', ((length - 1) << 12) | disp)
+			elif length <= 0x110:
+				length -= 0x11
+				out += struct.pack('>BH', length >> 4, ((length & 0xf) << 12) | disp)
+			else:
+				length -= 0x111
+				out += struct.pack('>HH', 0x1000 | (length >> 4), ((length & 0xf) << 12) | disp)
+		out[flags_pos] = flags
+	return str(out)
+
+# Compresses data (a string) with Huf8, 8-bit Huffman coding
+def compress_huf8(data):
+	header = size_header(len(data), 0x28)
+	freqs = {}
+	for byte in bytearray(data): freqs[byte] = freqs.get(byte, 0) + 1
+	if not freqs: freqs[0] = 1
+	# The decoder takes a leaf under the root for an endless loop, so codes
+	# must be at least two bits long; one-bit codes get a duplicate leaf.
+	tree = huffman_tree(freqs)
+	tree = tuple(child if type(child) == tuple else (child, child) for child in tree)
+	entries, codes = layout_tree(tree, 0x3f)
+
+	table = bytearray()
+	for entry in entries:
+		if type(entry) == tuple:
+			offset, left_leaf, right_leaf = entry
+			table.append(offset | (left_leaf and 0x80) | (right_leaf and 0x40))
+		else: table.append(entry)
+	# pad the table so that the bitstream is aligned to 4 bytes
+	table += '\0' * (-(len(table) + 5) % 4)
+
+	bits = MSBBitWriter()
+	for byte in bytearray(data): bits.write(*codes[byte])
+
+	# the bitstream is made of little-endian 32-bit words, read MSB first
+	stream = bits.getvalue(4)
+	words = bytearray(len(stream))
+	for i in xrange(4):
+		words[i::4] = stream[3-i::4]
+	return header + struct.pack('<B', (len(table) + 1) / 2 - 1) + str(table) + str(words)
+
+# Packs Huffman table entries for LZH8: the size in 32-bit words minus one
+# (size_bytes long), followed by the entries (bits each), padded to 4 bytes
+def lzh8_table(entries, bits, size_bytes):
+	writer = MSBBitWriter()
+	for entry in entries: writer.write(entry, bits)
+	body = writer.getvalue()
+	body += '\0' * (-(size_bytes + len(body)) % 4)
+	size = (size_bytes + len(body)) / 4 - 1
+	return struct.pack('<H' if size_bytes == 2 else '<B', size) + body
+
+# Converts layout_tree() entries to LZH8 table entries
+def lzh8_entries(entries, left_flag, right_flag):
+	out = []
+	for entry in entries:
+		if type(entry) == tuple:
+			offset, left_leaf, right_leaf = entry
+			out.append(offset | (left_leaf and left_flag) | (right_leaf and right_flag))
+		else: out.append(entry)
+	return out
+
+# Compresses data (a string) with LZH8, LZ77 with Huffman-coded symbols
+def compress_lzh8(data):
+	tokens = tokenize(data, 0, len(data), 0x1000, 0x102)
+	length_freqs = {}
+	disp_freqs = {}
+	symbols = []
+	for token in tokens:
+		if type(token) == tuple:
+			length, disp = token
+			disp -= 1
+			disp_bits = bit_length(disp)
+			symbol = 0x100 + length - 3
+			length_freqs[symbol] = length_freqs.get(symbol, 0) + 1
+			disp_freqs[disp_bits] = disp_freqs.get(disp_bits, 0) + 1
+			symbols.append((symbol, disp_bits, disp))
+		else:
+			length_freqs[token] = length_freqs.get(token, 0) + 1
+			symbols.append(token)
+	if not length_freqs: length_freqs[0] = 1
+
+	entries1, codes1 = layout_tree(huffman_tree(length_freqs), 0x7f)
+	table1 = lzh8_table(lzh8_entries(entries1, 0x100, 0x80), 9, 2)
+	if disp_freqs:
+		entries2, codes2 = layout_tree(huffman_tree(disp_freqs), 0x7)
+		table2 = lzh8_table(lzh8_entries(entries2, 0x10, 0x08), 5, 1)
+	else:
+		table2 = lzh8_table([0], 5, 1)
+
+	bits = MSBBitWriter()
+	for symbol in symbols:
+		if type(symbol) == tuple:
+			symbol, disp_bits, disp = symbol
+			bits.write(*codes1[symbol])
+			bits.write(*codes2[disp_bits])
+			if disp_bits > 1: bits.write(disp, disp_bits - 1)
+		else:
+			bits.write(*codes1[symbol])
+
+	return size_header(len(data), 0x40, True) + table1 + table2 + bits.getvalue()
+
+# romchu length and displacement codes: (extra bits, base value) for each
+# symbol, as built by romchu.init_backref_tables()
+def romchu_backref_tables():
+	lengths = [(0, i) for i in xrange(8)]
+	for scale in xrange(1, 6):
+		for base in xrange(1 << (scale + 2), 1 << (scale + 3), 1 << scale):
+			lengths.append((scale, base))
+	lengths.append((0, 255))
+
+	disps = [(0, i) for i in xrange(4)]
+	base = 4
+	for scale in xrange(1, 14):
+		for i in xrange(2):
+			disps.append((scale, base))
+			base += 1 << scale
+	return lengths, disps
+
+ROMCHU_LENGTHS, ROMCHU_DISPS = romchu_backref_tables()
+
+# returns (symbol, extra bits, extra value) coding value with a romchu backref table
+def romchu_code(table, value):
+	for symbol in xrange(len(table) - 1, -1, -1):
+		bits, base = table[symbol]
+		if base <= value < base + (1 << bits): return symbol, bits, value - base
+	raise ValueError('value %d out of range' % value)
+
+# Returns Huffman code lengths of at most limit bits for a list of symbol
+# frequencies; every symbol gets a code
+def huffman_lengths(freqs, limit=15):
+	freqs = [freq + 1 for freq in freqs]
+	while True:
+		lengths = [0] * len(freqs)
+		stack = [(huffman_tree(dict(enumerate(freqs))), 0)]
+		while stack:
+			node, depth = stack.pop()
+			if type(node) == tuple:
+				stack.append((node[0], depth + 1))
+				stack.append((node[1], depth + 1))
+			else: lengths[node] = depth
+		if max(lengths) <= limit: return lengths
+		# flatten the frequencies until the codes fit
+		freqs = [(freq >> 1) + 1 for freq in freqs]
+
+# returns the canonical Huffman codes for a list of code lengths
+def canonical_codes(lengths):
+	counts = [0] * 32
+	for length in lengths: counts[length] += 1
+	next_code = [0] * 32
+	code = 0
+	for length in xrange(1, 32):
+		code = (code + counts[length-1]) << 1
+		next_code[length] = code
+	codes = []
+	for length in lengths:
+		codes.append(next_code[length])
+		next_code[length] += 1
+	return codes
+
+# Writes romchu code lengths, as runs of a repeated length or of literal lengths.
+# Returns (number of bits, table).
+def romchu_table(lengths):
+	bits = LSBBitWriter()
+	i = 0
+	while i < len(lengths):
+		run = 1
+		while i + run < len(lengths) and lengths[i+run] == lengths[i] and run < 129: run += 1
+		if run >= 2:
+			bits.write(1, 1)
+			bits.write(run - 2, 7)
+			bits.write(lengths[i], 5)
+			i += run
+		else:
+			count = min(128, len(lengths) - i)
+			bits.write(0, 1)
+			bits.write(count - 1, 7)
+			for length in lengths[i:i+count]: bits.write(length, 5)
+			i += count
+	return bits.bits, bits.getvalue()
+
+# Compresses data (a string) as a type 2 romc (romchu) file.
+# block_size: bytes of input per block, each with its own Huffman tables
+# raw_every: if nonzero, store every raw_every-th block uncompressed
+def compress_romchu(data, block_size=0x10000, raw_every=0):
+	out = [struct.pack('>I', (len(data) << 2) | 2)]
+	for block, start in enumerate(xrange(0, len(data), block_size)):
+		end = min(len(data), start + block_size)
+		if raw_every and (block + 1) % raw_every == 0:
+			out.append(struct.pack('<I', (end - start) << 1))
+			out.append(data[start:end])
+			continue
+
+		symbol_freqs = [0] * 0x11d
+		disp_freqs = [0] * 0x1e
+		symbols = []
+		for token in tokenize(data, start, end, 0x8000, 258):
+			if type(token) == tuple:
+				length, disp = token
+				length_code = romchu_code(ROMCHU_LENGTHS, length - 3)
+				disp_code = romchu_code(ROMCHU_DISPS, disp - 1)
+				symbol_freqs[0x100 + length_code[0]] += 1
+				disp_freqs[disp_code[0]] += 1
+				symbols.append((length_code, disp_code))
+			else:
+				symbol_freqs[token] += 1
+				symbols.append(token)
+
+		symbol_lengths = huffman_lengths(symbol_freqs)
+		disp_lengths = huffman_lengths(disp_freqs)
+		symbol_codes = canonical_codes(symbol_lengths)
+		disp_codes = canonical_codes(disp_lengths)
+
+		bits = LSBBitWriter()
+		for symbol in symbols:
+			if type(symbol) == tuple:
+				(length_symbol, length_bits, length_extra), (disp_symbol, disp_bits, disp_extra) = symbol
+				length_symbol += 0x100
+				bits.writecode(symbol_codes[length_symbol], symbol_lengths[length_symbol])
+				bits.write(length_extra, length_bits)
+				bits.writecode(disp_codes[disp_symbol], disp_lengths[disp_symbol])
+				bits.write(disp_extra, disp_bits)
+			else:
+				bits.writecode(symbol_codes[symbol], symbol_lengths[symbol])
+
+		table1_bits, table1 = romchu_table(symbol_lengths)
+		table2_bits, table2 = romchu_table(disp_lengths)
+		payload = struct.pack('<H', table1_bits) + table1 + struct.pack('<H', table2_bits) + table2
+		# the block size is in bits, including the 32-bit block header
+		block_bits = 32 + len(payload) * 8 + bits.bits
+		out.append(struct.pack('<I', (block_bits << 1) | 1))
+		out.append(payload + bits.getvalue())
+	return ''.join(out)
+
+# the decompressed size of a type 1 romc file is a multiple of this
+ROMC_LZ77_UNIT = 4 * 1024 * 1024
+
+# Compresses data (a string) as a romc file of the given compression type: 1
+# (LZ77) or 2 (romchu).  For type 1, the size of data must be a multiple of 4 MB.
+def compress_romc(data, compression_type=2):
+	if compression_type == 2: return compress_romchu(data)
+	elif compression_type == 1:
+		if len(data) % ROMC_LZ77_UNIT or len(data) / ROMC_LZ77_UNIT > 0xff:
+			raise ValueError('type 1 romc size must be a multiple of 4 MB, up to 1020 MB')
+		return struct.pack('>BBBB', len(data) / ROMC_LZ77_UNIT, 0, 0, 1) + lz77_body(data, 0x10, 18)
+	else: raise ValueError('unknown romc compression type %d' % compression_type)
+
+if __name__ == '__main__':
+	import sys
+	encoders = {
+		'lz77-10': lambda data: compress_lz77(data, 0x10),
+		'lz77-11': lambda data: compress_lz77(data, 0x11),
+		'huf8': compress_huf8,
+		'lzh8': compress_lzh8,
+		'romc1': lambda data: compress_romc(data, 1),
+		'romc2': lambda data: compress_romc(data, 2),
+	}
+	if len(sys.argv) != 4 or sys.argv[1] not in encoders:
+		sys.stderr.write('Usage: %s %s infile outfile\n' % (sys.argv[0], '|'.join(sorted(encoders))))
+		sys.exit(1)
+
+	data = open(sys.argv[2], 'rb').read()
+	outfile = open(sys.argv[3], 'wb')
+	outfile.write(encoders[sys.argv[1]](data))
+	outfile.close()
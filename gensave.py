@@ -6,26 +6,37 @@
 
 import struct
 
-# src, dest: filesystem paths
-def convert(src, dest):
-	infile = open(src, 'rb')
-	outfile = open(dest, 'wb')
-	
+# Converts the contents of a VC Genesis save to the contents of a .srm file.
+# Each byte of SRAM becomes the low byte of a big-endian 16-bit word, and the
+# output is written in 1 KB pieces, like the SRAM file was.
+# data: contents of the VC save, as a string
+# Returns a string.
+def convert_data(data):
 	# read VC header
-	assert infile.read(4) == 'VCSD'
-	size1 = struct.unpack('<I', infile.read(4))[0] # size of expanded file + size of SRAM block (0x8)
-	infile.read(4) # not sure what these 4 bytes do
-	assert infile.read(4) == 'SRAM'
-	size = struct.unpack('<I', infile.read(4))[0] # size of expanded file; equal to (size1 - 0x8)
+	assert data[0:4] == 'VCSD'
+	size1 = struct.unpack('<I', data[4:8])[0] # size of expanded file + size of SRAM block (0x8)
+	# data[8:12]: not sure what these 4 bytes do
+	assert data[12:16] == 'SRAM'
+	size = struct.unpack('<I', data[16:20])[0] # size of expanded file; equal to (size1 - 0x8)
 	assert size == size1 - 0x8
 	
-	while outfile.tell() < size:
-		data = infile.read(512)
-		intdata = struct.unpack('>512B', data)
-		outfile.write(struct.pack('>512H', *intdata))
+	length = (size + 1023) / 1024 * 512 # bytes of SRAM
+	sram = data[20:20+length]
+	if len(sram) != length: raise ValueError('Genesis save file is truncated')
 	
-	outfile.close()
+	out = bytearray(2 * length)
+	out[1::2] = sram
+	return str(out)
+
+# src, dest: filesystem paths
+def convert(src, dest):
+	infile = open(src, 'rb')
+	data = infile.read()
 	infile.close()
+	
+	outfile = open(dest, 'wb')
+	outfile.write(convert_data(data))
+	outfile.close()
 
 if __name__ == '__main__':
 	import sys
@@ -7,12 +7,12 @@ import os, struct
 from array import array
 
 def decompress(infile, outfile):
-	infile.seek(0, os.SEEK_END)
-	file_length = infile.tell()
 	infile.seek(0, os.SEEK_SET)
+	data = infile.read()
+	file_length = len(data)
 
 	# read header
-	magic_declength, symbol_count = struct.unpack('<IB', infile.read(5))
+	magic_declength, symbol_count = struct.unpack_from('<IB', data)
 	if (magic_declength & 0xFF) != 0x28:
 		raise ValueError("not 8-bit Huffman")
 	decoded_length = magic_declength >> 8
@@ -20,7 +20,7 @@ def decompress(infile, outfile):
 
 	# read decode table
 	decode_table_size = symbol_count * 2 - 1
-	decode_table = array('B', infile.read(decode_table_size))
+	decode_table = array('B', data[5:5+decode_table_size])
 	
 	'''
 	print "encoded size = %ld bytes (%d header + %ld body)" % (
@@ -29,37 +29,69 @@ def decompress(infile, outfile):
 	print "decoded size = %ld bytes" % decoded_length
 	'''
 
-	# decode
-	bits = 0
-	bits_left = 0
-	table_offset = 0
+	# The bitstream is made of little-endian 32-bit words, read MSB first.
+	# Reverse the bytes of each word so the stream can be read a byte at a
+	# time, MSB first.
+	body = data[5+decode_table_size:]
+	body += '\0' * (-len(body) % 4)
+	stream = bytearray(len(body))
+	for i in xrange(4):
+		stream[i::4] = body[3-i::4]
+
+	# decode a whole input byte per step; transitions are computed on first use
+	transitions = [None] * (256 * max(decode_table_size, 1))
+	out = bytearray(decoded_length)
 	bytes_decoded = 0
+	table_offset = 0
+
+	for byte in stream:
+		if bytes_decoded >= decoded_length: break
+		key = (table_offset << 8) | byte
+		transition = transitions[key]
+		if transition is None:
+			transition = transitions[key] = step(decode_table, decode_table_size, table_offset, byte)
+		symbols, table_offset = transition
+		
+		if symbols:
+			out[bytes_decoded:bytes_decoded+len(symbols)] = symbols
+			bytes_decoded += len(symbols)
+		
+		# errors only count if they happen before the end of the output; the
+		# rest of the last word is padding
+		if table_offset < 0 and bytes_decoded < decoded_length:
+			if table_offset == -1: raise ValueError("reading past end of decode table")
+			else: raise ValueError("infinite loop in Huf8 decompression")
 
-	while bytes_decoded < decoded_length:
-		if bits_left == 0:
-			bits = struct.unpack("<I", infile.read(4))[0]
-			bits_left = 32
+	if bytes_decoded < decoded_length:
+		raise ValueError("Huf8 bitstream ended early")
+	
+	outfile.write(out[:decoded_length])
 
-		current_bit = ((bits & 0x80000000) != 0)
+# Runs the 8 bits of byte (MSB first) through the decode table, starting at the
+# node at table_offset.  Returns (decoded symbols, next node offset); the offset
+# is -1 or -2 if decoding runs past the end of the table or loops.
+def step(decode_table, decode_table_size, table_offset, byte):
+	symbols = ''
+	for i in xrange(7, -1, -1):
+		current_bit = (byte >> i) & 1
 		next_offset = (((table_offset + 1) / 2 * 2) + 1 +
 			(decode_table[table_offset] & 0x3f) * 2 +
 			current_bit)
 
 		if next_offset >= decode_table_size:
-			raise ValueError("reading past end of decode table")
+			return symbols, -1
 
 		if ((not current_bit and (decode_table[table_offset] & 0x80)) or
 			(    current_bit and (decode_table[table_offset] & 0x40))):
-			outfile.write(chr(decode_table[next_offset]))
-			bytes_decoded += 1
+			symbols += chr(decode_table[next_offset])
 			# print "%02x" % decode_table[next_offset]
 			next_offset = 0
 		
 		if next_offset == table_offset:
-			raise ValueError("infinite loop in Huf8 decompression")
+			return symbols, -2
 		table_offset = next_offset
-		bits_left -= 1
-		bits <<= 1
+	
+	return symbols, table_offset
 
 if __name__ == "__main__":
 	import sys
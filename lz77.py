@@ -5,9 +5,13 @@
 # Description: Decompresses LZ77-encoded files and compressed N64 ROMs.
 
 import sys, os, struct
+import progress
 from array import array
 from cStringIO import StringIO
 
+# bytes of output between two progress updates
+PROGRESS_STEP = 0x10000
+
 class BaseLZ77(object):
 	TYPE_LZ77_10 = 0x10
 	TYPE_LZ77_11 = 0x11
@@ -18,80 +22,115 @@ class BaseLZ77(object):
 		else: raise ValueError("Unsupported compression method %d"%self.compression_type)
 	
 	def uncompress_10(self):
-		dout = array('c', '\0' * self.uncompressed_length)
-		offset = 0
- 
+		length = self.uncompressed_length
 		self.file.seek(self.offset + 0x4)
+		src = bytearray(self.file.read())
+		pos = 0
+		dout = bytearray()
  
-		while offset < self.uncompressed_length:
-			flags = ord(self.file.read(1))
+		next_report = PROGRESS_STEP
+		while len(dout) < length:
+			if len(dout) >= next_report:
+				progress.update('decompress lz77', len(dout), length)
+				next_report = len(dout) + PROGRESS_STEP
+			flags = src[pos]
+			pos += 1
+			
+			# eight literals in a row
+			if flags == 0 and len(dout) + 8 <= length:
+				dout += src[pos:pos+8]
+				pos += 8
+				continue
  
 			for i in xrange(8):
 				if flags & 0x80:
-					info = struct.unpack(">H", self.file.read(2))[0]
-					num = 3 + (info>>12)
-					disp = info & 0xFFF
-					ptr = offset - disp - 1
-					for i in xrange(num):
-						dout[offset] = dout[ptr]
-						ptr += 1
-						offset += 1
-						if offset >= self.uncompressed_length:
-							break
+					info = (src[pos] << 8) | src[pos+1]
+					pos += 2
+					copy_backref(dout, (info & 0xFFF) + 1, 3 + (info>>12))
 				else:
-					dout[offset] = self.file.read(1)
-					offset += 1
+					dout.append(src[pos])
+					pos += 1
 				flags <<= 1
-				if offset >= self.uncompressed_length:
+				if len(dout) >= length:
 					break
- 
+		
+		# a backreference may run past the end of the output
+		del dout[length:]
+		# only finish the progress line if one was started
+		if next_report > PROGRESS_STEP: progress.update('decompress lz77', length, length)
 		self.data = dout
 		return self.data
 	
 	def uncompress_11(self):
-		dout = array('c', '\0'*self.uncompressed_length)
-		offset = 0
-		
 		self.file.seek(self.offset + 0x4)
 		
 		if not self.uncompressed_length:
 			self.uncompressed_length = struct.unpack("<I", self.file.read(4))[0]
 		
-		while offset < self.uncompressed_length:
-			flags = ord(self.file.read(1))
+		length = self.uncompressed_length
+		src = bytearray(self.file.read())
+		pos = 0
+		dout = bytearray()
+		
+		next_report = PROGRESS_STEP
+		while len(dout) < length:
+			if len(dout) >= next_report:
+				progress.update('decompress lz77', len(dout), length)
+				next_report = len(dout) + PROGRESS_STEP
+			flags = src[pos]
+			pos += 1
+			
+			# eight literals in a row
+			if flags == 0 and len(dout) + 8 <= length:
+				dout += src[pos:pos+8]
+				pos += 8
+				continue
 			
 			for i in xrange(7, -1, -1):
 				if (flags & (1<<i)) > 0:
-					info = struct.unpack(">H", self.file.read(2))[0]
-					ptr, num = 0, 0
+					info = (src[pos] << 8) | src[pos+1]
+					pos += 2
 					if info < 0x2000:
 						if info >= 0x1000:
-							info2 = struct.unpack(">H", self.file.read(2))[0]
-							ptr = offset - (info2 & 0xFFF) - 1
+							info2 = (src[pos] << 8) | src[pos+1]
+							pos += 2
+							disp = (info2 & 0xFFF) + 1
 							num = (((info & 0xFFF) << 4) | (info2 >> 12)) + 273
 						else:
-							info2 = ord(self.file.read(1))
-							ptr = offset - (((info & 0xF) << 8) | info2) - 1
+							info2 = src[pos]
+							pos += 1
+							disp = (((info & 0xF) << 8) | info2) + 1
 							num = ((info&0xFF0)>>4) + 17
 					else:
-						ptr = offset - (info & 0xFFF) - 1
+						disp = (info & 0xFFF) + 1
 						num = (info>>12) + 1
-					for i in xrange(num):
-						dout[offset] = dout[ptr]
-						offset += 1
-						ptr += 1
-						if offset >= self.uncompressed_length:
-							break
+					copy_backref(dout, disp, num)
 				else:
-					dout[offset] = self.file.read(1)
-					offset += 1
+					dout.append(src[pos])
+					pos += 1
 				
-				if offset >= self.uncompressed_length:
+				if len(dout) >= length:
 					break
 		
+		# a backreference may run past the end of the output
+		del dout[length:]
+		# only finish the progress line if one was started
+		if next_report > PROGRESS_STEP: progress.update('decompress lz77', length, length)
 		self.data = dout
 		return dout
 
+# Appends num bytes to the bytearray dout, copied from disp bytes back.
+# If the source overlaps the bytes being written, the copy repeats the last
+# disp bytes, so the pattern is repeated until it covers the whole run.
+def copy_backref(dout, disp, num):
+	start = len(dout) - disp
+	if start < 0:
+		raise ValueError("backreference before start of output")
+	if disp >= num:
+		dout += dout[start:start+num]
+	else:
+		dout += (dout[start:] * (num / disp + 1))[:num]
+
 class WiiLZ77(BaseLZ77):
 	def __init__(self, file):
 		self.file = file
@@ -123,6 +162,7 @@ if __name__ == '__main__':
 	import time
 	f = open(sys.argv[1], 'rb')
 	
+	progress.configure(progress.ConsoleSink())
 	start = time.clock()
 	unc = WiiLZ77(f)
 	try:
@@ -136,7 +176,7 @@ if __name__ == '__main__':
 	#du = romc_decode(f)
 	 
 	f2 = open(sys.argv[2], 'wb')
-	f2.write(''.join(du))
+	f2.write(du)
 	f2.close()
 	f.close()
 
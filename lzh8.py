@@ -43,6 +43,8 @@
 
 import sys, os, struct
 from array import array
+from bitreader import MSBBitReader
+from lz77 import copy_backref
 
 VERSION = "0.8"
 
@@ -58,186 +60,163 @@ DISPBITS = 5
 LENCNT = (1 << LENBITS)
 DISPCNT = (1 << DISPBITS)
 
-# globals
-input_offset = 0
-bit_pool = 0 # uint8_t
-bits_left = 0
-
-# read MSB->LSB order
-'''static inline uint16_t get_next_bits(
-		FILE *infile,
-		long * const offset_p,
-		uint8_t * const bit_pool_p,
-		int * const bits_left_p,
-		const int bit_count)'''
-def get_next_bits(infile, bit_count):
-	global input_offset, bit_pool, bits_left
-	
-	offset_p = input_offset
-	bit_pool_p = bit_pool
-	bits_left_p = bits_left
-	
-	out_bits = 0
-	num_bits_produced = 0
-	while num_bits_produced < bit_count:
-		if bits_left_p == 0:
-			infile.seek(offset_p)
-			bit_pool_p = struct.unpack("<B", infile.read(1))[0]
-			bits_left_p = 8
-			offset_p += 1
+# number of bits resolved by the direct lookup tables; deeper codes continue
+# down the tree one bit at a time
+LENGTH_LOOKUP_BITS = 10
+DISPLEN_LOOKUP_BITS = 6
+
+# LZH8 decoder.  All state lives in the object, so separate decoders can run
+# in separate threads.
+# data: string containing the whole compressed file
+class LZH8Decoder(object):
+	def __init__(self, data):
+		self.data = data
+		input_offset = 0
 		
-		bits_this_round = 0
-		if bits_left_p > (bit_count - num_bits_produced):
-			bits_this_round = bit_count - num_bits_produced
-		else:
-			bits_this_round = bits_left_p
-
-		out_bits <<= bits_this_round
-		out_bits |= (bit_pool_p >> (bits_left_p - bits_this_round)) & ((1 << bits_this_round) - 1)
-
-		bits_left_p -= bits_this_round
-		num_bits_produced += bits_this_round
-	
-	input_offset = offset_p
-	bit_pool = bit_pool_p
-	bits_left = bits_left_p
-	
-	return out_bits
+		# read header
+		header = struct.unpack_from("<I", data, input_offset)[0]
+		input_offset += 4
+		if (header & 0xFF) != 0x40: raise ValueError("not LZH8")
+		self.uncompressed_length = header >> 8
+		if self.uncompressed_length == 0:
+			self.uncompressed_length = struct.unpack_from("<I", data, input_offset)[0]
+			input_offset += 4
+
+		# read backreference length decode table
+		length_table_bytes = (struct.unpack_from("<H", data, input_offset)[0] + 1) * 4 # const uint32_t
+		self.length_decode_table = self.read_tree(input_offset + 2, length_table_bytes - 2, LENBITS, LENCNT * 2)
+		input_offset += length_table_bytes
+
+		# read backreference displacement length decode table
+		displen_table_bytes = (struct.unpack_from("<B", data, input_offset)[0] + 1) * 4 # const uint32_t
+		self.displen_decode_table = self.read_tree(input_offset + 1, displen_table_bytes - 1, DISPBITS, DISPCNT * 2)
+		input_offset += displen_table_bytes
+		
+		self.length_lookup = self.build_lookup(self.length_decode_table, 0x7F, 0x100, LENGTH_LOOKUP_BITS)
+		self.displen_lookup = self.build_lookup(self.displen_decode_table, 0x7, 0x10, DISPLEN_LOOKUP_BITS)
+		self.body_offset = input_offset
+
+	# Reads a bit packed tree table of the given number of bytes, with each
+	# node taking node_bits bits.  Node 0 is unused; the root is node 1.
+	def read_tree(self, offset, table_bytes, node_bits, table_size):
+		table = array('H', '\0' * table_size * 2)
+		bits = MSBBitReader(self.data, offset)
+		i = 1
+		while (bits.consumed + 7) / 8 < table_bytes:
+			if i >= table_size:
+				break
+			table[i] = bits.read(node_bits)
+			i += 1
+		return table
+
+	# Expands a tree table into a direct lookup table indexed by the next
+	# lookup_bits bits of input.  Entries are (symbol << 5) | code length for
+	# codes of up to lookup_bits bits, and -(node offset) for longer codes,
+	# where decoding continues bit by bit from that node.  Entries for child
+	# offsets outside the table are 0, and only fail if they are reached.
+	# payload_mask: mask for the child offset in a node
+	# leaf_flag: flag marking the left child as a leaf; leaf_flag >> 1 marks
+	# the right child as a leaf
+	def build_lookup(self, table, payload_mask, leaf_flag, lookup_bits):
+		lookup = [0] * (1 << lookup_bits)
+		stack = [(1, 0, 0)] # (node offset, code, code length)
+		while stack:
+			offset, code, length = stack.pop()
+			if length == lookup_bits:
+				lookup[code] = -offset
+				continue
+			for child in (0, 1):
+				child_offset = (offset / 2 * 2) + ((table[offset] & payload_mask) + 1) * 2 + child
+				if child_offset >= len(table): continue
+				child_code = (code << 1) | child
+				if table[offset] & (leaf_flag >> child):
+					entry = (table[child_offset] << 5) | (length + 1)
+					shift = lookup_bits - length - 1
+					start = child_code << shift
+					for i in xrange(start, start + (1 << shift)):
+						lookup[i] = entry
+				else:
+					stack.append((child_offset, child_code, length + 1))
+		return lookup
+
+	# Decodes one symbol using a lookup table built by build_lookup
+	def decode_symbol(self, bits, lookup, lookup_bits, table, payload_mask, leaf_flag):
+		entry = lookup[bits.peek(lookup_bits)]
+		if entry > 0:
+			bits.consume(entry & 0x1F)
+			return entry >> 5
+		if entry == 0:
+			raise ValueError("LZH8 tree offset out of range")
+		
+		# walk the rest of the tree
+		bits.consume(lookup_bits)
+		offset = -entry
+		while True:
+			child = bits.read(1)
+			next_offset = (offset / 2 * 2) + ((table[offset] & payload_mask) + 1) * 2 + child
+			if table[offset] & (leaf_flag >> child):
+				return table[next_offset]
+			assert next_offset != offset # stuck in a loop somehow
+			offset = next_offset
+
+	# returns the decompressed data as a string
+	def decompress(self):
+		uncompressed_length = self.uncompressed_length
+		length_lookup, length_table = self.length_lookup, self.length_decode_table
+		displen_lookup, displen_table = self.displen_lookup, self.displen_decode_table
+		decode_symbol = self.decode_symbol
+		
+		bits = MSBBitReader(self.data, self.body_offset)
+		peek = bits.peek
+		consume = bits.consume
+		read = bits.read
+		outbuf = bytearray()
+
+		# main decode loop
+		while len(outbuf) < uncompressed_length:
+			# get next backreference length or literal byte
+			entry = length_lookup[peek(LENGTH_LOOKUP_BITS)]
+			if entry > 0:
+				consume(entry & 0x1F)
+				length = entry >> 5
+			else:
+				length = decode_symbol(bits, length_lookup, LENGTH_LOOKUP_BITS, length_table, 0x7F, 0x100)
+
+			if 0x100 > length:
+				# literal byte
+				outbuf.append(length)
+				continue
+			
+			# backreference
+			length = (length & 0xFF) + 3
+			
+			# get backreference displacement length
+			entry = displen_lookup[peek(DISPLEN_LOOKUP_BITS)]
+			if entry > 0:
+				consume(entry & 0x1F)
+				displen = entry >> 5
+			else:
+				displen = decode_symbol(bits, displen_lookup, DISPLEN_LOOKUP_BITS, displen_table, 0x7, 0x10)
+			
+			displacement = 0
+			if displen != 0:
+				displacement = 1   # normalized
+				
+				# collect the bits
+				if displen > 1:
+					displacement = (1 << (displen-1)) | read(displen-1)
+			
+			# apply backreference
+			copy_backref(outbuf, displacement + 1, length)
+		
+		# a backreference may run past the end of the output
+		del outbuf[uncompressed_length:]
+		return str(outbuf)
 
 # void analyze_LZH8(FILE *infile, FILE *outfile, long file_length)
 def decompress(infile):
-	global input_offset, bit_pool, bits_left
-	input_offset = 0
-	bit_pool = 0
-	bits_left = 0
-	
-	# determine input file size
-	infile.seek(0, os.SEEK_END)
-	file_length = infile.tell()
-	
-	# read header
-	infile.seek(input_offset)
-	header = struct.unpack("<I", infile.read(4))[0]
-	if (header & 0xFF) != 0x40: raise ValueError("not LZH8")
-	uncompressed_length = header >> 8
-	if uncompressed_length == 0:
-		uncompressed_length = struct.unpack("<I", f.read(4))[0]
-
-	# allocate output buffer
-	outbuf = array('B', '\0' * uncompressed_length) # uint8_t*
-
-	# allocate backreference length decode table
-	length_table_bytes = (struct.unpack("<H", infile.read(2))[0] + 1) * 4 # const uint32_t
-	length_decode_table_size = LENCNT * 2 # const long
-	length_decode_table = array('H', '\0' * length_decode_table_size * 2) # uint16_t* const 
-	
-	input_offset = infile.tell()
-
-	# read backreference length decode table
-	#if SHOW_TABLE: print "backreference length table"
-	start_input_offset = input_offset-2
-	i = 1
-	bits_left = 0
-	while (input_offset - start_input_offset) < length_table_bytes:
-		if i >= length_decode_table_size:
-			break
-		length_decode_table[i] = get_next_bits(infile, LENBITS)
-		i += 1
-		#if SHOW_TABLE: print "%ld: %d" % (i-1, length_decode_table[i-1])
-	input_offset = start_input_offset + length_table_bytes
-	bits_left = 0
-	#if SHOW_TABLE: print "done at 0x%lx" % input_offset
-
-	# allocate backreference displacement length decode table
-	infile.seek(input_offset)
-	displen_table_bytes = (struct.unpack("<B", infile.read(1))[0] + 1) * 4 # const uint32_t
-	input_offset += 1
-	displen_decode_table = array('B', '\0' * (DISPCNT * 2)) # uint8_t* const
-
-	# read backreference displacement length decode table
-	#if SHOW_TABLE: print "backreference displacement length table"
-	start_input_offset = input_offset-1
-	i = 1
-	bits_left = 0
-	while (input_offset - start_input_offset < displen_table_bytes):
-		if i >= length_decode_table_size:
-			break
-		displen_decode_table[i] = get_next_bits(infile, DISPBITS)
-		i += 1
-		#if SHOW_TABLE: print "%ld: %d" % (i-1, displen_decode_table[bit_pool = 0 # uint8_ti-1])
-	input_offset = start_input_offset + displen_table_bytes
-	bits_left = 0
-	
-	#if SHOW_TABLE: print "done at 0x%lx" % input_offset
-
-	bytes_decoded = 0
-
-	# main decode loop
-	while bytes_decoded < uncompressed_length:
-		length_table_offset = 1
-
-		# get next backreference length or literal byte
-		while True:
-			next_length_child = get_next_bits(infile, 1)
-			length_node_payload = length_decode_table[length_table_offset] & 0x7F
-			next_length_table_offset =  (length_table_offset / 2 * 2) + (length_node_payload + 1) * 2 + bool(next_length_child)
-			next_length_child_isleaf = length_decode_table[length_table_offset] & (0x100 >> next_length_child)
-
-			if next_length_child_isleaf:
-				length = length_decode_table[next_length_table_offset]
-
-				if 0x100 > length:
-					# literal byte
-					outbuf[bytes_decoded] = length
-					bytes_decoded += 1
-				else:
-					# backreference
-					length = (length & 0xFF) + 3
-					displen_table_offset = 1
-					
-					# get backreference displacement length
-					while True:
-						next_displen_child = get_next_bits(infile, 1)
-						displen_node_payload = displen_decode_table[displen_table_offset] & 0x7
-						next_displen_table_offset = (displen_table_offset / 2 * 2) + (displen_node_payload + 1) * 2 + bool(next_displen_child)
-						next_displen_child_isleaf = displen_decode_table[displen_table_offset] & (0x10 >> next_displen_child)
-
-						if next_displen_child_isleaf:
-							displen = displen_decode_table[next_displen_table_offset]
-							displacement = 0
-
-							if displen != 0:
-								displacement = 1   # normalized
-
-								# collect the bits
-								#for (uint16_t i = displen-1; i > 0; i--)
-								for i in range(displen-1, 0, -1):
-									displacement *= 2
-									next_bit = get_next_bits(infile, 1)
-									
-									displacement |= next_bit
-
-							# apply backreference
-							#for (long i = 0; i < length && bytes_decoded < uncompressed_length; bytes_decoded ++, i ++)
-							for i in range(length):
-								outbuf[bytes_decoded] = outbuf[bytes_decoded - displacement - 1]
-								bytes_decoded += 1
-								if bytes_decoded >= uncompressed_length: break
-
-							break # break out of displen tree traversal loop
-						else:
-							assert next_displen_table_offset != displen_table_offset # stuck in a loop somehow
-							displen_table_offset = next_displen_table_offset
-					# end of displen tree traversal loop
-				# end of if backreference !(0x100 > length)*/
-				break # break out of length tree traversal loop
-			else:
-				assert next_length_table_offset != length_table_offset # "stuck in a loop somehow"
-				length_table_offset = next_length_table_offset
-		# end of length tree traversal
-	# end of main decode loop
-	
-	return outbuf.tostring()
+	infile.seek(0)
+	return LZH8Decoder(infile.read()).decompress()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Description: Records what was extracted for each title, so that a later run
+# 	can skip titles whose contents and extracted files haven't changed.
+
+import os, os.path, hashlib, json
+
+# name of the manifest file in the output directory
+MANIFEST_NAME = 'manifest.json'
+
+# returns the SHA-1 of a file as a hex string
+def sha1file(path):
+	h = hashlib.sha1()
+	f = open(path, 'rb')
+	while True:
+		data = f.read(65536)
+		if not data: break
+		h.update(data)
+	f.close()
+	return h.hexdigest()
+
+# Returns the files extracted for a title, relative to the output directory:
+# the ROM and saves (named after the title) and the manual.
+def title_outputs(name):
+	outputs = []
+	for filename in os.listdir('.'):
+		if filename.startswith(name + '.') and os.path.isfile(filename):
+			outputs.append(filename)
+	for dirpath, dirnames, filenames in os.walk(os.path.join('manuals', name)):
+		for filename in filenames:
+			outputs.append(os.path.join(dirpath, filename))
+	return sorted(outputs)
+
+# Titles and paths are byte strings, and titles aren't UTF-8 (see
+# NandDump.formattitle), but JSON only holds unicode.  They're stored as
+# Latin-1, which maps every byte to a character and back.
+ENCODING = 'latin-1'
+
+# returns a value loaded from JSON with its unicode strings turned back into
+# byte strings
+def to_bytes(value):
+	if isinstance(value, unicode): return value.encode(ENCODING)
+	if isinstance(value, list): return [to_bytes(item) for item in value]
+	if isinstance(value, dict): return dict((to_bytes(key), to_bytes(item)) for key, item in value.items())
+	return value
+
+class Manifest(object):
+	# path: path of the manifest file; it's created by save() if it doesn't exist
+	def __init__(self, path=MANIFEST_NAME):
+		self.path = path
+		self.titles = {} # title ID -> {'inputs': ..., 'outputs': {path: SHA-1}}
+		if os.path.exists(path):
+			f = open(path, 'rb')
+			try: self.titles = to_bytes(json.load(f)['titles'])
+			except (ValueError, KeyError): print 'Ignoring invalid manifest %s' % path
+			f.close()
+
+	# Returns True if the title was extracted from the same inputs by an earlier
+	# run and its extracted files are still there, unmodified.
+	# inputs: JSON-compatible description of the title's contents (see
+	# NandDump.titleinputs); it must be made of lists, not tuples
+	def unchanged(self, id, inputs):
+		entry = self.titles.get(id)
+		if not entry or entry['inputs'] != inputs or not entry['outputs']: return False
+		for path, sha1 in entry['outputs'].items():
+			if not os.path.isfile(path) or sha1file(path) != sha1: return False
+		return True
+
+	# records the inputs and extracted files of a title
+	def update(self, id, inputs, outputs):
+		self.titles[id] = {
+			'inputs': inputs,
+			'outputs': dict((path, sha1file(path)) for path in outputs)
+		}
+
+	# writes the manifest to disk, replacing the old one only once it's complete
+	def save(self):
+		tmppath = self.path + '.tmp'
+		f = open(tmppath, 'wb')
+		json.dump({'version': 1, 'titles': self.titles}, f, indent=1, sort_keys=True, separators=(',', ': '),
+			encoding=ENCODING)
+		f.close()
+		if os.name == 'nt' and os.path.exists(self.path): os.remove(self.path)
+		os.rename(tmppath, self.path)
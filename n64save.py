@@ -4,7 +4,16 @@
 # Description: Converts Virtual Console N64 saves to Mupen64Plus N64 saves.
 # The save formats used by N64 Virtual Console games were reverse engineered by Bryan Cain.
 
-import os, shutil, struct
+import os, shutil
+from array import array
+
+# Byte-swaps the 32-bit words of an N64 SRAM or Flash RAM save, given as a
+# string.  Returns a string.
+def byteswap_sram(data):
+	if len(data) % 8192: raise ValueError('SRAM save file size should be a multiple of 8 KB')
+	words = array('I', data)
+	words.byteswap()
+	return words.tostring()
 
 # Converts (byte-swaps) Nintendo N64 SRAM and/or Flash RAM saves to little endian
 # SRAM and/or Flash RAM saves that can be used by Mupen64Plus and other emulators.
@@ -18,22 +27,15 @@ def convert_sram(src, name, size):
 	# copy original file as a big-endian save file
 	shutil.copy2(src, name+'.be'+ext)
 	
-	# open files
-	infile = open(src, 'rb')
-	outfile = open(name+'.le'+ext, 'wb')
-	
 	# byte-swap file
-	while True:
-		data = infile.read(8192)
-		if len(data) != 8192:
-			if len(data) != 0: raise ValueError('SRAM save file size should be a multiple of 8 KB')
-			break
-		
-		intdata = struct.unpack('>2048I', data)
-		outfile.write(struct.pack('<2048I', *intdata))
+	infile = open(src, 'rb')
+	data = byteswap_sram(infile.read())
+	infile.close()
 	
+	outfile = open(name+'.le'+ext, 'wb')
+	outfile.write(data)
 	outfile.close()
-	infile.close()
+	return [name+'.be'+ext, name+'.le'+ext]
 
 # Converts (truncates) Nintendo N64 EEPROM saves to the appropriate size so they 
 # can be used with Mupen64Plus and other N64 emulators.
@@ -47,15 +49,17 @@ def convert_eeprom(src, name):
 	
 	outfile.close()
 	infile.close()
+	return [name + '.eep']
 
+# Returns the paths of the converted save files
 def convert(src, name):
 	f = open(src, 'rb')
 	f.seek(0, os.SEEK_END)
 	size = f.tell()
 	f.close()
 	
-	if size in (4*1024, 16*1024): convert_eeprom(src, name)
-	elif size in (32*1024, 128*1024): convert_sram(src, name, size)
+	if size in (4*1024, 16*1024): return convert_eeprom(src, name)
+	elif size in (32*1024, 128*1024): return convert_sram(src, name, size)
 	else: raise ValueError('unknown save type (size=%d bytes)' % size)
 
 if __name__ == '__main__':
@@ -4,30 +4,37 @@
 # Updated: December 28, 2010
 # Extracts an NES ROM from a 00000001.app file from an NES Virtual Console game.
 
-import sys
-from cStringIO import StringIO
+import sys, mmap, struct
 
-# returns a file-like object
+# iNES header flag: a 512-byte trainer comes between the header and PRG ROM
+INES_TRAINER = 4
+
+# Returns the size of an NES ROM from its 16-byte iNES header: the header, the
+# trainer if there is one, 16 KB per PRG ROM bank and 8 KB per CHR ROM bank.
+def ines_size(header):
+	magic, prg_banks, chr_banks, flags6 = struct.unpack('<4sBBB', header[0:7])
+	size = 16 + 16 * 1024 * prg_banks + 8 * 1024 * chr_banks
+	if flags6 & INES_TRAINER: size += 512
+	return size
+
+# Finds the NES ROM in a 00000001.app file and copies it, and only it, into
+# memory.
+# app1: file object for the .app file
+# returns a bytearray, or None if there is no NES ROM in the file
 def extract_nes_rom(app1):
-	romoffset = 0
-	while True:
-		buf = app1.read(8192)
-		if buf.find('NES\x1a') >= 0: # Found NES ROM
-			romoffset += buf.find('NES\x1a')
-			break
-		elif len(buf) != 8192: # End of file, and no NES rom found
-			app1.close()
-			return None
-		else: romoffset += 8192
+	app1.seek(0, 2)
+	if app1.tell() == 0: return None
 	
-	# NES ROM found; calculate size and extract it (FIXME: size calculation doesn't work)
-	app1.seek(romoffset)
-	#size = 16 + 128 # 16-byte header, 128-byte title data (footer)
-	#size += 16 * 1024 * ord(app1.read(1)) # next byte: number of PRG banks, 16KB each
-	#size += 8 * 1024 * ord(app1.read(1)) # next byte: number of CHR banks, 8KB each
-	app1.seek(romoffset)
-	rom = StringIO(app1.read())
-	return rom
+	m = mmap.mmap(app1.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		romoffset = m.find('NES\x1a')
+		if romoffset < 0 or romoffset + 16 > len(m): return None
+		size = ines_size(m[romoffset:romoffset+16])
+		# the last bank may be cut short in a broken file; take what is there
+		size = min(size, len(m) - romoffset)
+		return bytearray(buffer(m, romoffset, size))
+	finally:
+		m.close()
 
 if __name__ == '__main__':
 	if len(sys.argv) != 3:
@@ -35,8 +42,9 @@ if __name__ == '__main__':
 	f = open(sys.argv[1], 'rb')
 	rom = extract_nes_rom(f)
 	f.close()
+	if rom is None: sys.exit('No NES ROM found in %s' % sys.argv[1])
 	f2 = open(sys.argv[2], 'wb')
-	f2.write(rom.read())
+	f2.write(rom)
 	f2.close()
 	print 'Done!'
 	
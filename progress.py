@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Description: Progress reporting for long-running operations (decompression,
+# 	archive extraction, BRR restoration).  Operations call update(); what
+# 	happens to the updates is up to the configured sink, and they are
+# 	throttled so that a sink is called a few times per second at most.
+
+import os, sys, time, json
+
+# default minimum time between two updates of the same stage, in seconds
+DEFAULT_INTERVAL = 0.25
+
+# Writes a progress line for each update to the console, overwriting the
+# previous one, and ends the line when the stage completes or an update for
+# another stage comes in.
+# stream: file to write to; defaults to whatever sys.stdout is at the time
+class ConsoleSink(object):
+	def __init__(self, stream=None):
+		self.stream = stream
+		self.open = None # stage whose line hasn't been ended yet
+
+	def __call__(self, stage, done, total):
+		stream = self.stream or sys.stdout
+		if self.open is not None and self.open != stage: stream.write('\n')
+		if total: percent = 100.0 * done / total
+		else: percent = 100.0
+		stream.write('\r%s: %d of %d bytes (%5.2f%%)' % (stage, done, total, percent))
+		if done >= total:
+			stream.write('\n')
+			self.open = None
+		else: self.open = stage
+		stream.flush()
+
+# Writes each update to a file as a line of JSON, with the time and the ID of
+# the process it came from, for other programs to follow.
+# stream: file to write to; defaults to whatever sys.stderr is at the time
+class JSONLinesSink(object):
+	def __init__(self, stream=None):
+		self.stream = stream
+
+	def __call__(self, stage, done, total):
+		stream = self.stream or sys.stderr
+		# one write per line, so lines from several processes don't mix
+		stream.write(json.dumps({'stage': stage, 'done': done, 'total': total,
+			'time': round(time.time(), 3), 'pid': os.getpid()}) + '\n')
+		stream.flush()
+
+# Ignores all updates
+def null_sink(stage, done, total):
+	pass
+
+# Passes updates on to a sink, dropping those that come less than interval
+# seconds after the last one passed on for the same stage.  The first update of
+# a stage is always passed on, and the final (done >= total) one is passed on
+# only if an earlier one was, so that short operations stay silent.
+class Reporter(object):
+	def __init__(self, sink, interval=DEFAULT_INTERVAL):
+		self.sink = sink
+		self.interval = interval
+		self.last = {} # stage -> time of the last update passed on
+
+	def update(self, stage, done, total):
+		now = time.time()
+		finished = done >= total
+		if finished:
+			if self.last.pop(stage, None) is None: return
+		elif now - self.last.get(stage, 0) < self.interval: return
+		else: self.last[stage] = now
+		self.sink(stage, done, total)
+
+# the reporter updates go to, or None to ignore them
+reporter = None
+
+# Sets the sink updates are passed on to: any callable taking (stage, bytes
+# done, bytes total), such as a ConsoleSink or JSONLinesSink.  None, the
+# default, ignores updates at the cost of a single check per update.
+def configure(sink, interval=DEFAULT_INTERVAL):
+	global reporter
+	if sink is None: reporter = None
+	else: reporter = Reporter(sink, interval)
+
+# Reports that done of total bytes of a stage have been processed
+def update(stage, done, total):
+	if reporter is not None: reporter.update(stage, done, total)
+
+# returns a sink by name: 'console', 'json' or 'none' (None)
+def sink_by_name(name):
+	if name == 'console': return ConsoleSink()
+	elif name == 'json': return JSONLinesSink()
+	elif name == 'none': return None
+	else: raise ValueError('unknown progress sink %r' % name)
@@ -3,7 +3,7 @@
 # Date: January 17, 2011
 # Description: Decompresses Nintendo's romc compression used in N64 VC games.
 
-import lz77, romchu, struct
+import lz77, romchu, struct, decompcache, progress
 
 class RomcLZ77(lz77.BaseLZ77):
 	FOURMBYTE = 4194304 # 4MB rom size
@@ -14,7 +14,15 @@ class RomcLZ77(lz77.BaseLZ77):
 		self.uncompressed_length = self.FOURMBYTE * struct.unpack(">BBBB", self.file.read(4))[0]
 		self.compression_type = self.TYPE_LZ77_10
 
-def decompress(infile):
+# Returns the decompressed ROM as a bytearray.  The decompression cache is
+# consulted first, if one is configured.
+# workers: number of processes used for type 2 (romchu) decompression
+def decompress(infile, workers=1):
+	data = decompcache.decompress('romc', infile, lambda f: decompress_uncached(f, workers))
+	if type(data) != bytearray: data = bytearray(data)
+	return data
+
+def decompress_uncached(infile, workers=1):
 	# read compression type
 	infile.seek(0)
 	compression_type = struct.unpack(">BBBB", infile.read(4))[3] & 0x3
@@ -25,10 +33,30 @@ def decompress(infile):
 		dec = RomcLZ77(infile)
 		return dec.uncompress()
 	elif compression_type == 0x02: # LZ77+Huffman (romchu)
-		return romchu.decompress(infile)
+		return romchu.decompress(infile, workers)
 	else:
 		raise ValueError("unknown romc compression type %d" % compression_type)
 
+# Decompresses infile to the file-like object outfile.  Type 2 (romchu) is
+# written out block by block without holding the whole ROM in memory.
+# Returns the number of bytes written.
+def decompress_to(infile, outfile, workers=1):
+	return decompcache.decompress_to('romc', infile, outfile,
+		lambda f, out: decompress_to_uncached(f, out, workers))
+
+def decompress_to_uncached(infile, outfile, workers=1):
+	# read compression type
+	infile.seek(0)
+	compression_type = struct.unpack(">BBBB", infile.read(4))[3] & 0x3
+	
+	infile.seek(0)
+	if compression_type == 0x02: # LZ77+Huffman (romchu)
+		return romchu.decompress_to(infile, outfile, workers)
+	else:
+		data = decompress_uncached(infile, workers)
+		outfile.write(data)
+		return len(data)
+
 if __name__ == '__main__':
 	import sys, time
 	import cProfile
@@ -37,6 +65,7 @@ if __name__ == '__main__':
 		print 'Usage: %s infile outfile' % sys.argv[0]
 		sys.exit(1)
 	
+	progress.configure(progress.ConsoleSink())
 	infile = open(sys.argv[1], 'rb')
 	start = time.clock()
 	output = decompress(infile) # cProfile.run('output = decompress(infile)')
@@ -4,11 +4,18 @@
 # Date: January 17, 2011
 # Description: Decompresses Nintendo's N64 romc compression, type 2 (LZ77+Huffman)
 
-import sys, struct, time
+import sys, struct
+import progress
 from array import array
+from bitreader import LSBBitReader
+from lz77 import copy_backref
 
 VERSION = "0.6"
 
+# number of bits resolved by the primary Huffman lookup table; longer codes
+# continue into a secondary table
+FAST_BITS = 10
+
 class backref(object):
 	def __init__(self):
 		self.bits = 0
@@ -22,44 +29,25 @@ for i in xrange(0x1E):
 	backref_disp.append(backref())
 
 def main():
-	if len(sys.argv) != 3:
+	if len(sys.argv) not in (3, 4):
 		sys.stderr.write("romchu %s - romc type 2 decompressor\n" % VERSION)
-		sys.stderr.write("Usage: %s romc out.n64\n", sys.argv[0]);
+		sys.stderr.write("Usage: %s romc out.n64 [workers]\n" % sys.argv[0]);
 		sys.exit(1)
 
+	workers = 1
+	if len(sys.argv) == 4: workers = int(sys.argv[3])
+
 	infile = open(sys.argv[1], "rb")
 	outfile = open(sys.argv[2], "wb")
 	
-	outfile.write(decompress(infile))
+	progress.configure(progress.ConsoleSink())
+	decompress_to(infile, outfile, workers)
 	outfile.close()
 	infile.close()
 	print "ok!"
 
-def decompress(infile):
-	block_mult = 0x10000
-	block_count = 0
-	out_offset = 0
-	
-	# read header
-	infile.seek(0)
-	head_buf = infile.read(4)
-	#bs = init_bitstream(head_buf, 0, 4*8)
-
-	nominal_size = ord(head_buf[0])
-	nominal_size *= 0x100
-	nominal_size |= ord(head_buf[1])
-	nominal_size *= 0x100
-	nominal_size |= ord(head_buf[2])
-	nominal_size *= 0x40;
-	nominal_size |= ord(head_buf[3]) >> 2
-	romc_type = ord(head_buf[3]) & 0x3
-
-	if romc_type != 2:
-		raise ValueError("Expected type 2 romc, got %d\n" % romc_type)
-
-	#free_bitstream(bs)
-
-	# initialize backreference lookup tables
+# initialize backreference lookup tables
+def init_backref_tables():
 	for i in xrange(8):
 		backref_len[i].bits = 0
 		backref_len[i].base = i
@@ -91,23 +79,41 @@ def decompress(infile):
 			k += (1 << scale)
 			i += 1
 
-	# be lazy and just allocate memory for the whole file
-	out_buf = array('B', '\0' * nominal_size)
-	out_offset = 0
-	
-	start = time.clock()
+# the tables are constant, so set them up at import time; this also makes them
+# available in worker processes on platforms that don't fork
+init_backref_tables()
+
+# longest backreference distance
+MAX_DISP = backref_disp[-1].base + (1 << backref_disp[-1].bits)
+
+# Reads the romc header, returning the decompressed size
+def read_header(infile):
+	infile.seek(0)
+	head_buf = infile.read(4)
+	#bs = init_bitstream(head_buf, 0, 4*8)
+
+	nominal_size = ord(head_buf[0])
+	nominal_size *= 0x100
+	nominal_size |= ord(head_buf[1])
+	nominal_size *= 0x100
+	nominal_size |= ord(head_buf[2])
+	nominal_size *= 0x40;
+	nominal_size |= ord(head_buf[3]) >> 2
+	romc_type = ord(head_buf[3]) & 0x3
+
+	if romc_type != 2:
+		raise ValueError("Expected type 2 romc, got %d\n" % romc_type)
 
-	# decode each block
+	#free_bitstream(bs)
+	return nominal_size
+
+# Generator yielding (compression_flag, payload_buf, payload_bytes, payload_bits)
+# for each block, starting at the current position of infile
+def read_blocks(infile):
 	while True:
 		head_buf = infile.read(4)
 		if len(head_buf) != 4: break
 		
-		'''
-		printf("%08lx=%08lx\n",
-			(unsigned long)(ftell(infile)-4),
-			(unsigned long)block_count*block_mult);
-		'''
-
 		head_bs = init_bitstream(head_buf, 0, 4*8)
 
 		compression_flag = get_bits(head_bs, 1)
@@ -122,165 +128,195 @@ def decompress(infile):
 			payload_bytes = block_size
 			payload_bits = 0
 
-		#free_bitstream(head_bs)
-		head_bs = None
-
 		# read payload
 		read_size = payload_bytes
 		if payload_bits > 0:
 			read_size += 1
-
-		#this is not needed in Python
-		'''if read_size > len(payload_buf):
-			raise ValueError("payload too large")'''
 		
-		payload_buf = infile.read(read_size)
-
-		# attempt to parse...
-		if compression_flag:
-			# read table 1 size
-			tab1_offset = 0
-			bs = init_bitstream(payload_buf, tab1_offset, payload_bytes*8+payload_bits)
-			tab1_size = get_bits(bs, 16)
-			#free_bitstream(bs)
-
-			# load table 1
-			bs = init_bitstream(payload_buf, tab1_offset + 2, tab1_size)
-			table1 = load_table(bs, 0x11D)
-			#free_bitstream(bs)
-
-			# read table 2 size
-			tab2_offset = tab1_offset + 2 + (tab1_size+7) / 8
-			bs = init_bitstream(payload_buf, tab2_offset, 2*8)
-			tab2_size = get_bits(bs, 16)
-			#free_bitstream(bs)
-
-			# load table 2
-			bs = init_bitstream(payload_buf, tab2_offset + 2, tab2_size)
-			table2 = load_table(bs, 0x1E)
-			#free_bitstream(bs)
-
-			# decode body
-			body_offset = tab2_offset + 2 + (tab2_size+7) / 8
-			body_size = payload_bytes*8 + payload_bits - body_offset*8
-			bs = init_bitstream(payload_buf, body_offset, body_size)
-
-			while (bs.bits_left + bs.first_byte_bits) != 0:
-				symbol = huf_lookup(bs, table1)
-
-				if symbol < 0x100:
-					# byte literal
-					#unsigned char b = symbol;
-					b = symbol
-					assert out_offset <= nominal_size # generated too many bytes
-					out_buf[out_offset] = b
-					out_offset += 1
-				else:
-					# backreference
-					len_bits = backref_len[symbol-0x100].bits
-					length = backref_len[symbol-0x100].base
-					if len_bits > 0:
-						length += get_bits(bs, len_bits)
-					length += 3
-
-					symbol2 = huf_lookup(bs, table2)
-
-					disp_bits = backref_disp[symbol2].bits
-					disp = backref_disp[symbol2].base
-					if disp_bits > 0:
-						disp += get_bits(bs, disp_bits)
-					disp += 1
-
-					assert disp <= out_offset # backreference too far
-					assert (out_offset + length) <= nominal_size # generated too many bytes
-					
-					#for i in range(length):
-					count = 0
-					while count < length:
-						#for i in range(length):
-						out_buf[out_offset] = out_buf[out_offset-disp]
-						out_offset += 1
-						count += 1
-
-			#free_table(table1)
-			#free_table(table2)
-			#free_bitstream(bs)
-		else: # not compression_flag
-			assert (out_offset + payload_bytes) <= nominal_size # generated too many bytes
-			out_buf[out_offset:out_offset+payload_bytes] = payload_buf[0:payload_bytes]
-			out_offset += payload_bytes
-
-		block_count += 1
-		sys.stdout.write("\rDecompressed %d of %d bytes [%x/%x] (%5.2f%%)" % (out_offset, nominal_size, out_offset, nominal_size, 100.0 * out_offset / nominal_size))
-		sys.stdout.flush()
-		#print '\nDecompressed block %d in %.2f seconds' % (block_count, time.clock() - start)
+		yield compression_flag, infile.read(read_size), payload_bytes, payload_bits
+
+# Generator that decompresses a type 2 romc file, yielding the decompressed
+# data of each block as a bytearray.  Backreferences reach at most MAX_DISP
+# bytes back, so only that much of the earlier output is kept in memory.
+# workers: number of processes used to decode blocks in parallel.  Blocks carry
+# their own Huffman tables, so each one is entropy decoded to a token stream on
+# its own; backreferences, which may reach into earlier blocks, are resolved
+# afterwards in order by this process.
+def decompress_blocks(infile, workers=1):
+	block_count = 0
+	nominal_size = read_header(infile)
+	out_offset = 0
+	window = bytearray()
 	
-	print # start a new line after the progress counter
-	assert out_offset == nominal_size # size mismatch
+	pool = None
+	if workers > 1:
+		import multiprocessing
+		pool = multiprocessing.Pool(workers)
+		# imap returns results in block order, so they can be resolved as
+		# soon as they arrive
+		results = pool.imap(decode_block_job, read_blocks(infile), 4)
+	else:
+		results = (decode_block(*block) for block in read_blocks(infile))
 	
-	#print 'Average block time: %.2f seconds' % (time.clock() / block_count)
+	try:
+		# decode each block
+		for literals, ops in results:
+			start = len(window)
+			resolve_tokens(literals, ops, window)
+			block = window[start:]
+			out_offset += len(block)
+			assert out_offset <= nominal_size # generated too many bytes
+			del window[:-MAX_DISP]
+			
+			block_count += 1
+			progress.update('decompress romchu', out_offset, nominal_size)
+			yield block
+	finally:
+		if pool:
+			pool.terminate()
+			pool.join()
 	
+	assert out_offset == nominal_size # size mismatch
+
+# Decompresses a type 2 romc file to outfile, one block at a time.
+# Returns the number of bytes written.
+def decompress_to(infile, outfile, workers=1):
+	size = 0
+	for block in decompress_blocks(infile, workers):
+		outfile.write(block)
+		size += len(block)
+	return size
+
+# Decompresses a type 2 romc file, returning the whole output as a bytearray.
+def decompress(infile, workers=1):
+	out_buf = bytearray()
+	for block in decompress_blocks(infile, workers):
+		out_buf += block
 	return out_buf
+
+# picklable wrapper around decode_block for multiprocessing
+def decode_block_job(block):
+	return decode_block(*block)
+
+# Entropy decodes one block into a token stream, returned as (literals, ops).
+# literals holds the literal bytes of the block in order.  Each entry in ops is
+# either a positive count of bytes to take from literals, or a backreference
+# stored as -((length << 16) | displacement).
+def decode_block(compression_flag, payload_buf, payload_bytes, payload_bits):
+	if not compression_flag:
+		return bytearray(payload_buf[0:payload_bytes]), array('l', [payload_bytes])
+	
+	# read table 1 size
+	tab1_offset = 0
+	bs = init_bitstream(payload_buf, tab1_offset, payload_bytes*8+payload_bits)
+	tab1_size = get_bits(bs, 16)
+
+	# load table 1
+	bs = init_bitstream(payload_buf, tab1_offset + 2, tab1_size)
+	table1 = load_table(bs, 0x11D)
+
+	# read table 2 size
+	tab2_offset = tab1_offset + 2 + (tab1_size+7) / 8
+	bs = init_bitstream(payload_buf, tab2_offset, 2*8)
+	tab2_size = get_bits(bs, 16)
+
+	# load table 2
+	bs = init_bitstream(payload_buf, tab2_offset + 2, tab2_size)
+	table2 = load_table(bs, 0x1E)
+
+	# decode body
+	body_offset = tab2_offset + 2 + (tab2_size+7) / 8
+	body_size = payload_bytes*8 + payload_bits - body_offset*8
+	bs = init_bitstream(payload_buf, body_offset, body_size)
+	return decode_body(bs, table1, table2)
+
+# Decodes the Huffman-coded body of a compressed block into a token stream
+# (see decode_block).
+def decode_body(bs, table1, table2):
+	literals = bytearray()
+	ops = array('l')
+	literals_append = literals.append
+	ops_append = ops.append
+	run = 0
+	
+	decode = bs.decode
+	read = bs.read
+	fast1, sub1 = table1.fast, table1.sub
+	fast2, sub2 = table2.fast, table2.sub
+	len_bits = [b.bits for b in backref_len]
+	len_base = [b.base + 3 for b in backref_len]
+	disp_bits = [b.bits for b in backref_disp]
+	disp_base = [b.base + 1 for b in backref_disp]
+	
+	while bs.consumed < bs.size:
+		symbol = decode(fast1, sub1, FAST_BITS)
+		
+		if symbol < 0x100:
+			# byte literal
+			literals_append(symbol)
+			run += 1
+			continue
+		
+		# backreference
+		if run:
+			ops_append(run)
+			run = 0
+		
+		symbol -= 0x100
+		length = len_base[symbol]
+		if len_bits[symbol]:
+			length += read(len_bits[symbol])
+		
+		symbol2 = decode(fast2, sub2, FAST_BITS)
+		disp = disp_base[symbol2]
+		if disp_bits[symbol2]:
+			disp += read(disp_bits[symbol2])
+		
+		ops_append(-((length << 16) | disp))
+	
+	if run:
+		ops_append(run)
 	
+	return literals, ops
+
+# Applies a block's token stream (see decode_block) to the end of the
+# bytearray out_buf, which must hold at least MAX_DISP bytes of the
+# preceding output (or all of it, if there is less).
+def resolve_tokens(literals, ops, out_buf):
+	lit_offset = 0
+	for op in ops:
+		if op > 0:
+			out_buf += literals[lit_offset:lit_offset+op]
+			lit_offset += op
+			continue
+		
+		op = -op
+		length = op >> 16
+		disp = op & 0xFFFF
+		
+		assert disp <= len(out_buf) # backreference too far
+		copy_backref(out_buf, disp, length)
 
 # bitstream reader
-class bitstream(object):
-	def __init__(self):
-		#const unsigned char* pool
-		#long bits_left
-		#uint8_t first_byte
-		#int first_byte_bits
-		self.pool = None
-		self.bits_left = 0
-		self.first_byte = 0
-		self.first_byte_bits = 0
-		self.index = 0
-
 # struct bitstream *init_bitstream(const unsigned char *pool, unsigned long pool_size)
 def init_bitstream(pool_buf, pool_start, pool_size):
-	bs = bitstream()
-
-	bs.pool = array('B', pool_buf[pool_start:pool_start+pool_size])
-	bs.bits_left = pool_size
-	bs.first_byte_bits = 0
+	bs = LSBBitReader(pool_buf, pool_start, pool_size)
 
 	# check that padding bits are 0 (to ensure we aren't ignoring anything)
 	if pool_size % 8:
-		if bs.pool[pool_size/8] & ~((1<<(pool_size%8))-1):
+		if ord(bs.data[pool_size/8]) & ~((1<<(pool_size%8))-1):
 			raise ValueError("nonzero padding at end of bitstream")
 	
 	return bs
 
 # uint32_t get_bits(struct bitstream *bs, int bits)
 def get_bits(bs, bits):
-	accum = 0
-
 	if bits > 32:
 		raise ValueError("get_bits() supports max 32")
-	if bits > (bs.bits_left + bs.first_byte_bits):
+	if bits > bs.bits_left():
 		raise ValueError("get_bits() underflow")
 	
-	count = 0
-	#for i in range(bits):
-	while count < bits:
-		if bs.first_byte_bits == 0:
-			#print bs.bits_left, len(bs.pool), i
-			bs.first_byte = bs.pool[bs.index]
-			bs.index += 1
-			if bs.bits_left >= 8:
-				bs.first_byte_bits = 8
-				bs.bits_left -= 8
-			else:
-				bs.first_byte_bits = bs.bits_left
-				bs.bits_left = 0
-
-		accum >>= 1
-		accum |= (bs.first_byte & 1) << 31
-		bs.first_byte >>= 1
-		bs.first_byte_bits -= 1
-		count += 1
-
-	return accum >> (32-bits)
+	return bs.read(bits)
 
 def free_bitstream(bs):
 	pass
@@ -311,6 +347,10 @@ class huftable(object):
 	def __init__(self):
 		self.symbols = 0
 		self.t = []
+		# flat lookup tables, indexed by the next FAST_BITS bits of input
+		# (first bit in the LSB); see build_lookup()
+		self.fast = []
+		self.sub = []
 
 # struct huftable *load_table(struct bitstream *bs, int symbols)
 def load_table(bs, symbols):
@@ -339,7 +379,7 @@ def load_table(bs, symbols):
 				len_count[length] += 1
 				i += 1
 
-	assert (bs.bits_left + bs.first_byte_bits) == 0 # did not exhaust bitstream reading table
+	assert bs.bits_left() == 0 # did not exhaust bitstream reading table
 
 	# compute the first canonical Hufman code for each length
 	accum = 0
@@ -357,12 +397,14 @@ def load_table(bs, symbols):
 		node.right = 0
 		ht.t.append(node)
 	
+	code_of = [0] * symbols
 	next_free_node = 1
 	for i in xrange(symbols):
 		cur = 0
 		if length_of[i] == 0:
 			# 0 length indicates absent symbol
 			continue
+		code_of[i] = codes[length_of[i]]
 		
 		#for (int j = length_of[i]-1; j >= 0; j --)
 		for j in xrange(length_of[i]-1, -1, -1):
@@ -391,33 +433,51 @@ def load_table(bs, symbols):
 
 		codes[length_of[i]] += 1
 
+	build_lookup(ht, length_of, code_of)
 	return ht
 
-# int huf_lookup(struct bitstream *bs, struct huftable *ht)
-def huf_lookup(bs, ht):
-	cur = 0
-	while not ht.t[cur].is_leaf:
-		if bs.first_byte_bits == 0:
-			bs.first_byte = bs.pool[bs.index]
-			bs.index += 1
-			if bs.bits_left >= 8:
-				bs.first_byte_bits = 8
-				bs.bits_left -= 8
-			else:
-				bs.first_byte_bits = bs.bits_left
-				bs.bits_left = 0
+# Builds the flat decoding tables for a Huffman table.  Codes are read starting
+# with their most significant bit, so the table index is the bit-reversed code.
+# Each entry is (symbol << 5) | code length.  Codes longer than FAST_BITS get a
+# primary entry of (subtable index << 5) with a length of 0, and the subtable
+# is indexed by the bits following the first FAST_BITS.  Unused entries are -1.
+def build_lookup(ht, length_of, code_of):
+	fast = [-1] * (1 << FAST_BITS)
+	sub = []
+	long_codes = {} # primary index -> [(reversed remainder, length, symbol)]
+	
+	for i in xrange(len(length_of)):
+		length = length_of[i]
+		if length == 0: continue
+		code = code_of[i]
+		rev = 0
+		for j in xrange(length):
+			rev = (rev << 1) | ((code >> j) & 1)
 		
-		#if get_bits(bs, 1):
-		if bs.first_byte & 1:
-			# 1 == right
-			cur = ht.t[cur].right
+		if length <= FAST_BITS:
+			entry = (i << 5) | length
+			for k in xrange(rev, 1 << FAST_BITS, 1 << length):
+				fast[k] = entry
 		else:
-			cur = ht.t[cur].left
-		
-		bs.first_byte >>= 1
-		bs.first_byte_bits -= 1
+			prefix = rev & ((1 << FAST_BITS) - 1)
+			long_codes.setdefault(prefix, []).append((rev >> FAST_BITS, length, i))
+	
+	for prefix, entries in long_codes.iteritems():
+		sub_bits = max([length for rest, length, i in entries]) - FAST_BITS
+		table = [-1] * (1 << sub_bits)
+		for rest, length, i in entries:
+			entry = (i << 5) | length
+			for k in xrange(rest, 1 << sub_bits, 1 << (length - FAST_BITS)):
+				table[k] = entry
+		fast[prefix] = len(sub) << 5
+		sub.append(((1 << sub_bits) - 1, table))
+	
+	ht.fast = fast
+	ht.sub = sub
 
-	return ht.t[cur].symbol
+# int huf_lookup(struct bitstream *bs, struct huftable *ht)
+def huf_lookup(bs, ht):
+	return bs.decode(ht.fast, ht.sub, FAST_BITS)
 
 # void free_table(struct huftable *ht)
 def free_table(ht):
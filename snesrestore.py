@@ -7,108 +7,152 @@
 import os
 import sys
 import struct
-from brrencode3 import BRREncoder
+import progress
+from array import array
+from itertools import izip
+from brrencode3 import BRREncoder, BlockCache, read_pcm
 from cStringIO import StringIO
 
-# vcrom: file-like object for the original VC ROM
-# brr: file-like object containing the BRR-compressed audio samples
-# Precondition: brr is the correct size
-def restore_brr_samples(vcrom, pcm):
-	# read the samples from the input ROM into memory (TODO: check file size first)
-	vcrom.seek(0)
-	str = vcrom.read()
-	samplestart = str.find('PCMF') # samples start with first instance of the string "PCMF"
-	str = str[samplestart:]
-	
-	# initialize output ROM in memory as a StringIO (pseudo-file)
-	rom = StringIO()
-	rom.write(str)
-	
-	# read the input BRR samples
-	#brr.seek(0)
-	#brrdata = brr.read()
-	#lastbrroffset = None
-	
-	enc = BRREncoder(pcm, None)
+# Finds the PCMF records in a VC ROM.  Each one takes the place of a 9-byte BRR
+# block of a sound sample, and holds 'PCMF', the 24-bit offset of the block's
+# samples in the PCM file and a byte of flags, so the search for the next one
+# resumes after those 9 bytes.
+# rom: the ROM as a string or bytearray
+# Returns a list of (ROM offset, PCM offset in samples, flags).
+def find_pcmf_records(rom):
+	records = []
 	lastpcmoffset = None
-	
-	# misc. variables
-	#goodrom = open('SNADNE1.667', 'rb')
-	wrong = 0
-	controlwrong = 0
-	indices = []
-	
-	while str.find('PCMF') >= 0:
-		index = str.find('PCMF')
-		filepos = samplestart + index
-		
-		# error checking to prevent infinite loops
-		#assert index not in indices
-		#indices.append(index)
-		
-		pcmf, pcmoffset = struct.unpack('<4sI', str[index:index+8])
+	index = rom.find('PCMF')
+	while index >= 0:
+		pcmoffset = struct.unpack('<I', str(rom[index+4:index+8]))[0]
+		flags = pcmoffset >> 24
 		pcmoffset &= 0xffffff
 		if pcmoffset % 16 or pcmoffset < lastpcmoffset:
-			#print '%08x: unexpected offset %d' % (filepos, pcmoffset)
+			# not the start of a block, or behind the last one; assume it's
+			# the block after the last one
 			pcmoffset = lastpcmoffset + 16
-		#else:
-		#	brroffset = 9 * (brroffset >> 4)
-		
-		# read the BRR sample
-		#brr.seek(brroffset)
-		#brrsample = brr.read(9)
-		
-		# read and encode the BRR block
-		brrsample = enc.encode_block(pcmoffset)
-		
-		# error checking for invalid BRR offsets
-		if len(brrsample) != 9:
-			raise ValueError('Invalid BRR offset: %d' % brroffset)
-		
-		# set the END bit in the BRR sample if it is set in the PCMF block
-		if ord(str[index+7]) & 1:
-			brrsample = chr(ord(brrsample[0]) | 1) + brrsample[1:]
-		
-		# set the LOOP bit in the BRR sample if it is set in the PCMF block
-		if ord(str[index+7]) & 2:
-			brrsample = chr(ord(brrsample[0]) | 2) + brrsample[1:]
-		
-		# checks whether sample matches the original ROM, when the original ROM is available (for debugging purposes)
-		'''goodrom.seek(samplestart + index)
-		grsample = goodrom.read(9)
-		if brrsample != grsample:
-			wrong += 1
-			sys.stdout.write('%08x: ' % filepos)
-			#if brrdata.find(grsample) >= 0:
-			#	print 'wrong sample, correct BRR offset is %08x' % brrdata.find(grsample)
-			if brrsample[1:] == grsample[1:]:
-				if abs(ord(brrsample[0]) - ord(grsample[0])) <= 3:
-					controlwrong += 1
-					print 'SPC700 control bits differ'
-				else:
-					print 'flags are different'
-			else:
-				print 'sample encoded differently?' '''
-		
-		rom.seek(index)
-		rom.write(brrsample)
-		str = rom.getvalue()
+		records.append((index, pcmoffset, flags))
 		lastpcmoffset = pcmoffset
+		index = rom.find('PCMF', index + 9)
+	return records
+
+# Splits PCMF records into chains, each ending with a record with the END bit
+# set, or with the last record
+def split_chains(records):
+	chains = []
+	chain = []
+	for record in records:
+		chain.append(record)
+		if record[2] & 1:
+			chains.append(chain)
+			chain = []
+	if chain: chains.append(chain)
+	return chains
+
+# returns the 16 samples of the BRR block at a PCM offset
+def pcm_block(samples, pcmoffset):
+	block = samples[pcmoffset:pcmoffset+16]
+	if len(block) != 16:
+		raise ValueError('invalid PCM offset %d (file offset %d)' % (pcmoffset, pcmoffset*2))
+	return block
+
+# PCM samples and BlockCache of a process encoding chains
+chain_samples = None
+chain_cache = None
+
+# sets up a process encoding chains
+def init_chain_worker(samples):
+	global chain_samples, chain_cache
+	chain_samples = array('h', samples)
+	chain_cache = BlockCache()
+
+# Encodes the blocks at a list of PCM offsets, starting from an empty predictor
+# history.  Returns a list of (block, p1, p2) with the history after each
+# block, and the number of cache hits and misses.
+def encode_chain(offsets):
+	enc = BRREncoder(None, None)
+	hits = chain_cache.hits
+	misses = chain_cache.misses
+	blocks = []
+	for pcmoffset in offsets:
+		block = enc.encode_cached(chain_cache, pcm_block(chain_samples, pcmoffset))
+		blocks.append((block, enc.p1, enc.p2))
+	return blocks, chain_cache.hits - hits, chain_cache.misses - misses
+
+# Generator yielding (ROM offset, flags, BRR block) for each PCMF record, in
+# order.
+# workers: number of processes encoding chains at once
+def encode_records(records, samples, cache, workers=1):
+	enc = BRREncoder(None, None)
+	if workers <= 1:
+		for index, pcmoffset, flags in records:
+			yield index, flags, enc.encode_cached(cache, pcm_block(samples, pcmoffset))
+		return
 	
-	#print '%d wrong samples' % wrong
-	#print '%d differences in SPC700 control bits' % controlwrong
-	
-	rom.close()
+	# The predictor history carries over from one chain to the next, but the
+	# workers start each chain from an empty one.  The history usually gets
+	# back on track within a few blocks, so the first blocks of each chain are
+	# encoded again here from the real history until it matches the history
+	# the worker had at that point, and the rest of the worker's blocks are
+	# used as they are.  The output is the same as with a single process.
+	import multiprocessing
+	chains = split_chains(records)
+	pool = multiprocessing.Pool(workers, init_chain_worker, (samples.tostring(),))
+	try:
+		results = pool.imap(encode_chain, [[pcmoffset for index, pcmoffset, flags in chain] for chain in chains], 16)
+		for chain, (blocks, hits, misses) in izip(chains, results):
+			cache.hits += hits
+			cache.misses += misses
+			history = (0, 0) # the worker's history before block i
+			i = 0
+			while i < len(chain) and (enc.p1, enc.p2) != history:
+				index, pcmoffset, flags = chain[i]
+				yield index, flags, enc.encode_cached(cache, pcm_block(samples, pcmoffset))
+				history = blocks[i][1:]
+				i += 1
+			for (index, pcmoffset, flags), (block, p1, p2) in izip(chain[i:], blocks[i:]):
+				yield index, flags, block
+			if i < len(chain): enc.p1, enc.p2 = blocks[-1][1:]
+	finally:
+		pool.terminate()
+		pool.join()
+
+# Encodes the PCM samples as BRR and writes them over the PCMF records of a VC
+# ROM.  The ROM is patched in place in memory, and the PCM file is read once.
+# vcrom: file-like object for the original VC ROM
+# pcm: file-like object containing the 16-bit big-endian PCM samples
+# cache: BlockCache for the encoded blocks; a new one if not given
+# workers: number of processes to encode with; chains of blocks ending with
+# the END bit are spread over them
+# Returns the restored ROM as a string.
+def restore_brr_samples(vcrom, pcm, cache=None, workers=1):
 	vcrom.seek(0)
-	return vcrom.read(samplestart) + str
+	rom = bytearray(vcrom.read())
+	records = find_pcmf_records(rom)
+	samples = read_pcm(pcm)
+	if cache is None: cache = BlockCache()
+	
+	for index, flags, block in encode_records(records, samples, cache, workers):
+		rom[index:index+9] = block
+		
+		# set the END and LOOP bits of the BRR block if they are set in the
+		# PCMF record
+		rom[index] |= flags & 3
+		progress.update('restore BRR', index, len(rom))
+	
+	progress.update('restore BRR', len(rom), len(rom))
+	return str(rom)
 
 if __name__ == '__main__':
 	import time
 	
-	if len(sys.argv) != 4:
-		print 'Usage: snesrestore game.rom game.pcm output.smc'
+	if len(sys.argv) not in (4, 5):
+		print 'Usage: snesrestore game.rom game.pcm output.smc [workers]'
 		sys.exit(1)
 	
+	workers = 1
+	if len(sys.argv) == 5: workers = int(sys.argv[4])
+	
 	vcrom = open(sys.argv[1], 'rb')
 	pcm = open(sys.argv[2], 'rb')
 	
@@ -121,10 +165,13 @@ if __name__ == '__main__':
 	
 	# encode and inject BRR sound data into the ROM
 	print 'Encoding and restoring BRR audio data to ROM'
+	progress.configure(progress.ConsoleSink())
 	start = time.clock()
-	string = restore_brr_samples(vcrom, pcm)
+	cache = BlockCache()
+	string = restore_brr_samples(vcrom, pcm, cache, workers)
 	end = time.clock()
 	print 'Time: %.2f seconds' % (end - start)
+	print 'Block cache: %d hits, %d misses' % (cache.hits, cache.misses)
 	
 	# write to file
 	output = open(sys.argv[3], "wb")
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Description: Records the wall time, CPU time and bytes processed by each stage
+# 	of an extraction, and summarizes them per title and per stage.
+
+import os, time
+
+# returns the CPU time (user + system) used by this process so far
+def cpu_time():
+	times = os.times()
+	return times[0] + times[1]
+
+# A running stage; use it in a with statement.  bytes_in, bytes_out and the
+# extra fields in info can be set inside the with block when they aren't known
+# up front.
+class Stage(object):
+	def __init__(self, recorder, name, bytes_in, info):
+		self.recorder = recorder
+		self.name = name
+		self.bytes_in = bytes_in
+		self.bytes_out = 0
+		self.info = info
+
+	def __enter__(self):
+		self.depth = self.recorder.depth
+		self.recorder.depth += 1
+		self.wall = time.time()
+		self.cpu = cpu_time()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		record = {
+			'stage': self.name,
+			'depth': self.depth,
+			'wall': time.time() - self.wall,
+			'cpu': cpu_time() - self.cpu,
+			'bytes_in': self.bytes_in,
+			'bytes_out': self.bytes_out,
+		}
+		if type is not None: record['error'] = type.__name__
+		record.update(self.info)
+		self.recorder.depth -= 1
+		self.recorder.records.append(record)
+
+# Stand-in for Stage when nothing is being recorded
+class NullStage(object):
+	def __init__(self):
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.info = {}
+	def __enter__(self): return self
+	def __exit__(self, type, value, traceback): pass
+
+# Collects the stages of one title, in the order they finish.  Nested stages
+# have a greater depth than the stage around them.
+class Recorder(object):
+	def __init__(self):
+		self.records = []
+		self.depth = 0
+
+	def stage(self, name, bytes_in=0, **info):
+		return Stage(self, name, bytes_in, info)
+
+# the recorder stages are added to, or None if nothing is being recorded
+recorder = None
+
+# Sets the recorder for the following stages and returns the previous one.
+# None stops recording.
+def use(new_recorder):
+	global recorder
+	previous = recorder
+	recorder = new_recorder
+	return previous
+
+# Returns a context manager timing a stage of the current title.  Extra keyword
+# arguments are stored in the stage's record.
+def stage(name, bytes_in=0, **info):
+	if recorder is None: return NullStage()
+	return recorder.stage(name, bytes_in, **info)
+
+# Adds up the records of each stage over a list of title reports, each with a
+# 'stages' list of records.  Returns a list of dictionaries, slowest first.
+def aggregate(titles):
+	totals = {}
+	for title in titles:
+		for record in title['stages']:
+			total = totals.setdefault(record['stage'], {'stage': record['stage'], 'count': 0,
+				'wall': 0.0, 'cpu': 0.0, 'bytes_in': 0, 'bytes_out': 0})
+			total['count'] += 1
+			for key in ('wall', 'cpu', 'bytes_in', 'bytes_out'): total[key] += record[key]
+	return sorted(totals.values(), key=lambda total: -total['wall'])
+
+# Prints the slowest titles and stages of a list of title reports
+def print_summary(titles, count=10):
+	print 'Slowest titles:'
+	print '%8s %8s  %s' % ('wall (s)', 'cpu (s)', 'title')
+	for title in sorted(titles, key=lambda title: -title['wall'])[:count]:
+		print '%8.3f %8.3f  %s (ID: %s)' % (title['wall'], title['cpu'], title['name'], title['id'])
+	print
+	print 'Slowest stages (nested stages are also counted in the stages around them):'
+	print '%8s %8s %6s %12s %12s %9s  %s' % ('wall (s)', 'cpu (s)', 'count', 'bytes in', 'bytes out', 'MB/s out', 'stage')
+	for total in aggregate(titles)[:count]:
+		rate = total['bytes_out'] / (1024.0 * 1024.0) / max(total['wall'], 1e-9)
+		print '%8.3f %8.3f %6d %12d %12d %9.2f  %s' % (total['wall'], total['cpu'], total['count'],
+			total['bytes_in'], total['bytes_out'], rate, total['stage'])
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Description: Caches the archives and decompressed files of a single title,
+# 	so that each .app is opened once and no file is decompressed twice.
+
+import tempfile
+from cStringIO import StringIO
+import romc
+from u8archive import U8Archive, COMPRESSION_PREFIXES
+from ccfarchive import CCFArchive
+
+# default limit on the total size of cached decompressed files
+DEFAULT_BUDGET = 64 * 1024 * 1024
+
+class TitleSession(object):
+	# budget: maximum total size in bytes of the cached decompressed files;
+	# the least recently used files are dropped first
+	def __init__(self, budget=DEFAULT_BUDGET):
+		self.budget = budget
+		self.archives = {} # key -> U8Archive/CCFArchive, or None if not an archive
+		self.members = {} # key -> decompressed contents (string)
+		self.order = [] # member keys, least recently used first
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+
+	# returns the U8 archive at the given filesystem path, or None if the file
+	# isn't a U8 archive
+	def archive(self, path):
+		if path not in self.archives:
+			try:
+				self.archives[path] = U8Archive(path, use_mmap=True)
+			except AssertionError:
+				self.archives[path] = None
+		return self.archives[path]
+
+	# returns a U8 archive stored as a file in arc, or None if it can't be read
+	def u8(self, arc, name):
+		key = (id(arc), name, 'u8')
+		if key not in self.archives:
+			f = self.getfile(arc, name)
+			self.archives[key] = f and U8Archive(f)
+		return self.archives[key]
+
+	# returns a CCF archive stored as a file in arc, or None if it can't be read
+	def ccf(self, arc, name):
+		key = (id(arc), name, 'ccf')
+		if key not in self.archives:
+			f = self.getfile(arc, name)
+			self.archives[key] = f and CCFArchive(f)
+		return self.archives[key]
+
+	# Returns a U8 archive stored as a file in a CCF archive, or None if there
+	# is no such file.  The file is decompressed to a temporary file, which is
+	# memory-mapped, instead of into memory.
+	def ccf_u8(self, ccf, name):
+		key = (id(ccf), name, 'ccf-u8')
+		if key not in self.archives:
+			fd = ccf.names.get(name)
+			arc = None
+			if fd:
+				f = tempfile.TemporaryFile()
+				ccf.extractfile(fd, f)
+				f.flush()
+				f.seek(0)
+				try:
+					arc = U8Archive(f, use_mmap=True)
+				except AssertionError:
+					f.close()
+					raise
+			self.archives[key] = arc
+		return self.archives[key]
+
+	# returns a U8 archive stored as a romc-compressed file in arc
+	def romc_u8(self, arc, name):
+		key = (id(arc), name, 'romc')
+		if key not in self.archives:
+			data = self.cached((id(arc), name, 'romc'), lambda: str(romc.decompress(arc.getfile(name))))
+			self.archives[key] = U8Archive(StringIO(data))
+		return self.archives[key]
+
+	# Like arc.getfile(name), but decompressed files are cached.  Files stored
+	# uncompressed are cheap to get again and aren't cached.
+	def getfile(self, arc, name):
+		if isinstance(arc, CCFArchive):
+			fd = arc.names.get(name)
+			if not fd: return None
+			if not fd.compressed: return arc.getfile2(fd)
+			loader = lambda: arc.getfile2(fd).getvalue()
+		else:
+			if not name.startswith(COMPRESSION_PREFIXES): return arc.getfile(name)
+			def loader():
+				f = arc.getfile(name)
+				return f and f.getvalue()
+
+		data = self.cached((id(arc), name), loader)
+		if data is None: return None
+		return StringIO(data)
+
+	# returns the cached value for key, calling loader() to get it if needed
+	def cached(self, key, loader):
+		if key in self.members:
+			self.hits += 1
+			self.order.remove(key)
+			self.order.append(key)
+			return self.members[key]
+
+		self.misses += 1
+		data = loader()
+		if data is None or len(data) > self.budget: return data
+
+		while self.order and self.size + len(data) > self.budget:
+			evicted = self.order.pop(0)
+			self.size -= len(self.members.pop(evicted))
+		self.members[key] = data
+		self.order.append(key)
+		self.size += len(data)
+		return data
+
+	# closes every archive opened from the filesystem or a temporary file and
+	# empties the cache
+	def close(self):
+		for key, arc in self.archives.items():
+			if arc and (type(key) == str or key[-1] == 'ccf-u8'): arc.close()
+		self.archives = {}
+		self.members = {}
+		self.order = []
+		self.size = 0
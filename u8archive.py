@@ -3,13 +3,24 @@
 # Date: December 27, 2010
 # Description: Reads Wii U8 archives.
 
-import os, struct, posixpath
+import os, struct, posixpath, mmap
 from cStringIO import StringIO
-import lz77, huf8, lzh8
+import lz77, huf8, lzh8, decompcache, timing, progress
+
+# name prefixes marking compressed files, longest first
+COMPRESSION_PREFIXES = ("LZ77_", "LZ77", "Huf8_", "Huf8", "LZH8_", "LZH8")
+
+# returns a file name without its compression prefix, if it has one
+def normalize_name(name):
+	for prefix in COMPRESSION_PREFIXES:
+		if name.startswith(prefix): return name[len(prefix):]
+	return name
 
 class U8Archive(object):
 	# archive can be a string (filesystem path) or file-like object
-	def __init__(self, archive):
+	# use_mmap: memory-map the archive, if it is a real file, so that files
+	# stored uncompressed are returned as views of the mapping instead of copies
+	def __init__(self, archive, use_mmap=False):
 		if type(archive) == str:
 			#print archive
 			self.file = open(archive, 'rb')
@@ -17,7 +28,14 @@ class U8Archive(object):
 			self.file = archive
 		assert self.file
 		self.files = []
-		self.readheader()
+		self.names = {} # file name -> (position in self.files, node)
+		self.index = {} # file name without compression prefix -> (position, node)
+		self.map = None
+		with timing.stage('open U8 archive') as stage:
+			self.readheader()
+			stage.bytes_in = self.file.tell()
+		if use_mmap and hasattr(self.file, 'fileno'):
+			self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
 	
 	def readheader(self):
 		magic, rootnode_offset, header_size, data_offset = tuple(struct.unpack('>IIII', self.file.read(16)))
@@ -25,15 +43,25 @@ class U8Archive(object):
 		assert rootnode_offset == 0x20
 		assert self.file.read(16) == 16 * '\0'
 		
-		root = Node(self.file, rootnode_offset)
-		root.path = '<root>'
+		# read the node table and string table in one go; the root node's size
+		# is the total number of nodes
+		table = self.file.read(header_size)
+		count = struct.unpack_from('>III', table)[2]
+		assert count and len(table) >= 12 * count
+		entries = struct.unpack_from('>%dI' % (3 * count), table)
+		strings = buffer(table, 12 * count)
+		
 		path = ''
-		curdirs = [root.size]
+		curdirs = [count]
 		dirnames = ['<root>']
 		filenum = 1
-		while curdirs:
-			node = Node(self.file, rootnode_offset + 12 * root.size)
-			node.path = posixpath.join(path, node.name)
+		for i in xrange(3, 3 * count, 3):
+			chunk1 = entries[i]
+			name_offset = chunk1 & 0xffffff
+			# no sane file name should be more than 64 bytes; if one is, index() will throw an exception
+			name = strings[name_offset:name_offset+64]
+			name = name[0:name.index('\0')]
+			node = Node(chunk1 >> 16, name, posixpath.join(path, name), entries[i+1], entries[i+2])
 			filenum += 1
 			if node.type == 0x100:
 				# change current path if this is a directory
@@ -41,123 +69,147 @@ class U8Archive(object):
 				#print node.name, node.path
 				curdirs.append(node.size)
 				dirnames.append(node.name)
-			else: self.files.append(node)
+			else:
+				# only the first file with a given name is ever looked up
+				self.names.setdefault(node.name, (len(self.files), node))
+				self.index.setdefault(normalize_name(node.name), (len(self.files), node))
+				self.files.append(node)
 			
-			indices = range(len(curdirs))
-			indices.reverse()
 			while curdirs and filenum >= curdirs[len(curdirs)-1]:
 				#print 'done with ' + dirnames.pop() + ' at %d' % filenum
 				path = posixpath.dirname(path)
 				curdirs.pop()
 	
-	# closes the physical file associated with this archive
+	# Closes the physical file associated with this archive.  The mapping isn't
+	# closed explicitly: files returned by readnode() may still be reading from
+	# it, and unmapping it under them would crash the interpreter.  It is
+	# unmapped when the last of them is gone.
 	def close(self):
+		self.map = None
 		self.file.close()
 	
-	# returns True if this archive has a file with the given path
+	# returns a read-only file-like object for the raw (possibly compressed)
+	# contents of a file node; when the archive is memory-mapped, this is a
+	# cStringIO object over a buffer of the mapping, which is not copied
+	def readnode(self, node):
+		if self.map:
+			return StringIO(buffer(self.map, node.data_offset, node.size))
+		self.file.seek(node.data_offset)
+		return StringIO(self.file.read(node.size))
+	
+	# returns the node for a file name (or the node itself), or None
+	def lookup(self, path):
+		if type(path) != str: return path
+		if path in self.names: return self.names[path][1]
+		# fall back to matching the end of the name
+		for node in self.files:
+			if node.name.endswith(path): return node
+		return None
+	
+	# returns True if this archive has a file with the given path; this only
+	# looks at the file table and never reads the file itself
 	def hasfile(self, path):
-		f = self.getfile(path)
-		if f: f.close(); return True
-		else: return False
+		return self.lookup(path) is not None
 	
 	# returns a file-like object (actually a cStringIO object) for the specified
 	# file; detects and decompresses compressed files (LZ77/Huf8/LZH8) automatically!
 	# path: file name (string) or actual file node, but NOT node path :D
 	def getfile(self, path):
-		for node in self.files:
-			if node == path or (type(path) == str and node.name.endswith(path)):
-				if node == path: path = node.name
-				self.file.seek(node.data_offset)
-				file = StringIO(self.file.read(node.size))
-				if path.startswith("LZ77"):
-					try:
-						decompressed_file = lz77.decompress(file)
-						file.close()
-						return decompressed_file
-					except ValueError, IndexError:
-						print "LZ77 decompression of '%s' failed" % path
-						print 'Dumping compressed file to %s' % path
-						f2 = open(path, "wb")
-						f2.write(file.read())
-						f2.close()
-						file.close()
-						return None
-				elif path.startswith("Huf8"):
-					try:
-						decompressed_file = StringIO()
-						huf8.decompress(file, decompressed_file)
-						file.close()
-						decompressed_file.seek(0)
-						return decompressed_file
-					except Exception:
-						print "Huf8 decompression of '%s' failed" % path
-						print "Dumping compressed file to %s" % path
-						f2 = open(path, "wb")
-						f2.write(file.read())
-						f2.close()
-						file.close()
+		node = self.lookup(path)
+		if node:
+			if node == path: path = node.name
+			file = self.readnode(node)
+			if path.startswith("LZ77"):
+				try:
+					decompressed_file = StringIO(decompcache.decompress('lz77', file,
+						lambda f: lz77.decompress(f).getvalue()))
+					file.close()
 					return decompressed_file
-				elif path.startswith("LZH8"):
-					try:
-						decompressed_file = StringIO()
-						decompressed_file.write(lzh8.decompress(file))
-						decompressed_file.seek(0)
-						file.close()
-						return decompressed_file
-					except Exception:
-						print "LZH8 decompression of '%s' failed" % path
-						print "Dumping compressed file to %s" % path
-						f2 = open(path, "wb")
-						f2.write(file.read())
-						f2.close()
-						file.close()
-				else:
-					return file
+				except ValueError, IndexError:
+					print "LZ77 decompression of '%s' failed" % path
+					print 'Dumping compressed file to %s' % path
+					f2 = open(path, "wb")
+					f2.write(file.read())
+					f2.close()
+					file.close()
+					return None
+			elif path.startswith("Huf8"):
+				try:
+					decompressed_file = StringIO(decompcache.decompress('huf8', file, huf8_decompress))
+					file.close()
+					return decompressed_file
+				except Exception:
+					print "Huf8 decompression of '%s' failed" % path
+					print "Dumping compressed file to %s" % path
+					f2 = open(path, "wb")
+					f2.write(file.read())
+					f2.close()
+					file.close()
+					# an empty file, so that extract() carries on with the rest
+					return StringIO()
+			elif path.startswith("LZH8"):
+				try:
+					decompressed_file = StringIO(decompcache.decompress('lzh8', file, lzh8.decompress))
+					file.close()
+					return decompressed_file
+				except Exception:
+					print "LZH8 decompression of '%s' failed" % path
+					print "Dumping compressed file to %s" % path
+					f2 = open(path, "wb")
+					f2.write(file.read())
+					f2.close()
+					file.close()
+			else:
+				return file
 		return None
 	
 	# finds a file with the given name, accounting for compression prefixes like "LZ77", "Huf8", etc.
 	def findfile(self, name):
-		for f in self.files:
-			names = (name, "LZ77"+name, "LZ77_"+name, "Huf8"+name, "Huf8_"+name, "LZH8"+name, "LZH8_"+name)
-			if f.name in names: return f.name
-		return None
+		matches = [match for match in (self.names.get(name), self.index.get(name)) if match]
+		if not matches: return None
+		return min(matches)[1].name
 	
 	def extract(self, dest):
-		if not os.path.lexists(dest): os.makedirs(dest)
-		for node in self.files:
-			if node.name in ('<root>', '.'): continue
-			if node.type == 0x100:
-				os.makedirs(os.path.join(dest, node.path))
-				#print 'created dir %s' % os.path.join(dest, node.path)
-			else:
-				#print node.path
-				path = os.path.join(dest, node.path)
-				if not os.path.lexists(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
-				f = open(path, 'wb')
-				contents = self.getfile(node)
-				contents.seek(0)
-				f.write(contents.read())
-				f.close()
-				#print 'extracted file %s' % os.path.join(dest, node.path)
+		with timing.stage('extract U8 archive') as stage:
+			if not os.path.lexists(dest): os.makedirs(dest)
+			total = sum(node.size for node in self.files if node.type != 0x100)
+			done = 0
+			for node in self.files:
+				if node.name in ('<root>', '.'): continue
+				if node.type == 0x100:
+					os.makedirs(os.path.join(dest, node.path))
+					#print 'created dir %s' % os.path.join(dest, node.path)
+				else:
+					#print node.path
+					path = os.path.join(dest, node.path)
+					if not os.path.lexists(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+					f = open(path, 'wb')
+					contents = self.getfile(node)
+					contents.seek(0)
+					data = contents.read()
+					f.write(data)
+					f.close()
+					stage.bytes_out += len(data)
+					done += node.size
+					progress.update('extract U8 archive', done, total)
+					#print 'extracted file %s' % os.path.join(dest, node.path)
+
+# returns the Huf8-decompressed contents of a file-like object as a string
+def huf8_decompress(infile):
+	outfile = StringIO()
+	huf8.decompress(infile, outfile)
+	return outfile.getvalue()
 
 # file node object
 class Node(object):
-	def __init__(self, arcfile, stringoffset):
-		self.rawdata = arcfile.read(12)
-		arcpos = arcfile.tell()
-		chunk1, self.data_offset, self.size = tuple(struct.unpack('>III', self.rawdata))
-		self.type = chunk1 >> 16
-		self.name_offset = chunk1 & 0xffffff
-		
-		# the root node has a name_offset of 0
-		if not self.name_offset: return
-		
-		# no sane file name should be more than 64 bytes; if one is, string.index() will throw an exception
-		arcfile.seek(stringoffset + self.name_offset)
-		self.name = arcfile.read(64)
-		self.name = self.name[0:self.name.index('\0')]
-		#print self.name
-		arcfile.seek(arcpos)
+	__slots__ = ('type', 'name', 'path', 'data_offset', 'size')
+	
+	def __init__(self, type, name, path, data_offset, size):
+		self.type = type
+		self.name = name
+		self.path = path
+		self.data_offset = data_offset
+		self.size = size
 
 if __name__ == '__main__':
 	# Quick functionality test and sanity check; will only work on my (Plombo's) computer without a path change
@@ -5,21 +5,25 @@
 # Thanks to Leathl for writing Wii.cs in ShowMiiWads, which was an important 
 # reference in writing this program.
 
-import os, os.path, struct, shutil
+import os, os.path, sys, struct, shutil, traceback, mmap, json
 from cStringIO import StringIO
-import romc, gensave, n64save
-from u8archive import U8Archive
-from ccfarchive import CCFArchive
+import romc, gensave, n64save, decompcache, timing, progress
 from nes_rom_extract import extract_nes_rom
 from snesrestore import restore_brr_samples
+from brrencode3 import BlockCache
+from titlesession import TitleSession
+from manifest import Manifest, sha1file, title_outputs
 
 # rom: file-like object
 # path: string (filesystem path)
 def writerom(rom, path):
-	f = open(path, 'wb')
-	f.write(rom.read())
-	f.close()
-	rom.seek(0)
+	with timing.stage('write ROM') as stage:
+		f = open(path, 'wb')
+		# copy in chunks, so a ROM mapped from an archive is never copied whole
+		shutil.copyfileobj(rom, f)
+		stage.bytes_out = f.tell()
+		f.close()
+		rom.seek(0)
 
 class RomExtractor(object):
 	# file extensions for ROMs
@@ -37,8 +41,17 @@ class RomExtractor(object):
 		self.name = name
 		self.channeltype = channeltype
 		self.nand = nand
+		# archives and decompressed files shared by the ROM and manual extraction
+		self.session = TitleSession()
 	
+	# returns True if the ROM was extracted
 	def extract(self):
+		try:
+			return self.extractall()
+		finally:
+			self.session.close()
+	
+	def extractall(self):
 		content = os.path.join(self.nand.path, 'title', '00010001', self.id, 'content')
 		rom_extracted = False
 		manual_extracted = False
@@ -48,11 +61,12 @@ class RomExtractor(object):
 			app = os.path.join(content, app)
 			if self.extractrom(app): rom_extracted = True
 			if self.extractmanual(app): manual_extracted = True
-			if rom_extracted and manual_extracted: return
+			if rom_extracted and manual_extracted: return True
 		
 		if rom_extracted: print 'Unable to extract manual.'
 		elif manual_extracted: print 'Unable to extract ROM.'
 		else: print 'Unable to extract ROM and manual.'
+		return rom_extracted
 	
 	# Actually extract the ROM
 	# Currently works for almost all NES, SNES, N64, TG16, Master System, and Genesis ROMs.
@@ -69,18 +83,14 @@ class RomExtractor(object):
 		if self.channeltype == 'NES':
 			arc = u8path
 		else:
-			try:
-				arc = U8Archive(u8path)
-				if not arc: return False
-			except AssertionError:
-				return False
+			arc = self.session.archive(u8path)
+			if not arc: return False
 		
 		if self.channeltype in funcs.keys():
 			return funcs[self.channeltype](arc, self.name + self.extensions[self.channeltype])
 		else:
 			return False
 	
-	# FIXME: use string instead of StringIO
 	def extractrom_nes(self, u8path, filename):
 		if not os.path.exists(u8path): return False
 		
@@ -88,18 +98,16 @@ class RomExtractor(object):
 		rom = extract_nes_rom(f)
 		f.close()
 		
-		if not rom: return False
+		if rom is None: return False
 		
 		# make sure save flag is set if the game has save data
 		if self.extractsave():
-			if not (ord(rom.getvalue()[6]) & 2):
-				rom = list(rom.getvalue())
-				rom[6] = chr(ord(rom[6]) | 2)
-				rom = StringIO(''.join(rom))
+			if not (rom[6] & 2):
+				rom[6] |= 2
 				print 'Set the save flag to true'
 			
 		print 'Got ROM: %s' % filename
-		writerom(rom, filename)
+		writerom(StringIO(buffer(rom)), filename)
 		return True
 	
 	def extractrom_n64(self, arc, filename):
@@ -110,13 +118,13 @@ class RomExtractor(object):
 		elif arc.hasfile('romc'):
 			rom = arc.getfile('romc')
 			print 'Decompressing ROM: %s (this could take a minute or two)' % filename
+			outfile = open(filename, 'wb')
 			try:
-				romdata = romc.decompress(rom)
-				outfile = open(filename, 'wb')
-				outfile.write(romdata)
+				with timing.stage('write ROM') as stage:
+					stage.bytes_out = romc.decompress_to(rom, outfile)
 				outfile.close()
 				print 'Got ROM: %s' % filename
-			except IndexError: # unknown compression - something besides LZSS and romchu?
+			except (IndexError, ValueError): # unknown compression - something besides LZSS and romchu?
 				print 'Decompression failed: unknown compression type'
 				outfile.close()
 				os.remove(filename)
@@ -132,7 +140,7 @@ class RomExtractor(object):
 	
 	def extractrom_sega(self, arc, filename):
 		if arc.hasfile('data.ccf'):
-			ccf = CCFArchive(arc.getfile('data.ccf'))
+			ccf = self.session.ccf(arc, 'data.ccf')
 		
 			if ccf.hasfile('config'):
 				for line in ccf.getfile('config'):
@@ -143,8 +151,15 @@ class RomExtractor(object):
 			
 			if romname:
 				print 'Found ROM: %s' % romname
-				rom = ccf.find(romname)
-				writerom(rom, filename)
+				fd = ccf.finddescriptor(romname)
+				if not fd:
+					print 'ROM not found in data.ccf'
+					return False
+				# decompress straight to the output file
+				outfile = open(filename, 'wb')
+				with timing.stage('write ROM') as stage:
+					stage.bytes_out = ccf.extractfile(fd, outfile)
+				outfile.close()
 				print 'Got ROM: %s' % filename
 				
 				if self.extractsave(): print 'Extracted save to %s.srm' % self.name
@@ -219,14 +234,20 @@ class RomExtractor(object):
 			
 					# inject BRR audio into the ROM
 					print 'Encoding and restoring BRR audio data to ROM'
-					romdata = restore_brr_samples(vcrom, pcm)
+					with timing.stage('restore BRR', decompcache.file_size(vcrom) + decompcache.file_size(pcm)) as stage:
+						cache = BlockCache()
+						romdata = restore_brr_samples(vcrom, pcm, cache)
+						stage.bytes_out = len(romdata)
+						stage.info.update(block_cache_hits=cache.hits, block_cache_misses=cache.misses)
 					vcrom.close()
 					pcm.close()
 			
 					# write the recreated ROM to disk
-					f = open(filename, 'wb')
-					f.write(romdata)
-					f.close()
+					with timing.stage('write ROM') as stage:
+						stage.bytes_out = len(romdata)
+						f = open(filename, 'wb')
+						f.write(romdata)
+						f.close()
 					print 'Got ROM: %s' % filename
 					extracted = True
 		
@@ -241,6 +262,17 @@ class RomExtractor(object):
 	
 	# copy save file, doing any necessary conversions to common emulator formats
 	def extractsave(self):
+		with timing.stage('convert save') as stage:
+			save = self.convertsave()
+			if not save: return False
+			path, outputs = save
+			stage.bytes_in = os.path.getsize(path)
+			stage.bytes_out = sum(os.path.getsize(output) for output in outputs)
+			return True
+	
+	# Does the work of extractsave.  Returns (path of the save file, paths of
+	# the converted files), or None if no save was found.
+	def convertsave(self):
 		datadir = os.path.join(self.nand.path, 'title', '00010001', self.id, 'data')
 		datafiles = os.listdir(datadir)
 		
@@ -251,7 +283,7 @@ class RomExtractor(object):
 					# VC SNES saves are standard SRM files
 					outpath = self.name + '.srm'
 					shutil.copy2(path, outpath)
-					return True
+					return path, [outpath]
 				elif self.channeltype == 'NES':
 					# VC NES saves use the same format as FCEUX, except with an
 					# additional 64-byte header
@@ -262,42 +294,37 @@ class RomExtractor(object):
 					outfile.write(infile.read())
 					outfile.close()
 					infile.close()
-					return True
+					return path, [outpath]
 				elif self.channeltype == 'Genesis':
 					# VC Genesis saves use a slightly different format from 
 					# the one used by Gens/GS and other emulators
 					outpath = self.name + '.srm'
 					gensave.convert(path, outpath)
-					return True
+					return path, [outpath]
 			elif filename.startswith('EEP_') or filename.startswith('RAM_'):
 				assert self.channeltype == 'Nintendo 64'
-				n64save.convert(path, self.name)
-				return True
+				return path, n64save.convert(path, self.name)
 		
-		return False
+		return None
 	
 	def extractmanual(self, u8path):
-		try:
-			arc = U8Archive(u8path)
-			if not arc: return False
-		except AssertionError: 
-			return False
+		arc = self.session.archive(u8path)
+		if not arc: return False
 	
 		man = None
 		try:
 			if arc.findfile('emanual.arc'):
-				man = U8Archive(arc.getfile(arc.findfile('emanual.arc')))
+				man = self.session.u8(arc, arc.findfile('emanual.arc'))
 			elif arc.findfile('html.arc'):
-				man = U8Archive(arc.getfile(arc.findfile('html.arc')))
+				man = self.session.u8(arc, arc.findfile('html.arc'))
 			elif arc.findfile('man.arc'):
-				man = U8Archive(arc.getfile(arc.findfile('man.arc')))
+				man = self.session.u8(arc, arc.findfile('man.arc'))
 			elif arc.findfile('data.ccf'):
-				ccf = CCFArchive(arc.getfile(arc.findfile('data.ccf')))
-				man = U8Archive(ccf.getfile('man.arc'))
+				ccf = self.session.ccf(arc, arc.findfile('data.ccf'))
+				man = self.session.ccf_u8(ccf, 'man.arc')
 			elif arc.findfile('htmlc.arc'):
-				manc = arc.getfile(arc.findfile('htmlc.arc'))
 				print 'Decompressing manual: htmlc.arc'
-				man = U8Archive(StringIO(romc.decompress(manc)))
+				man = self.session.romc_u8(arc, arc.findfile('htmlc.arc'))
 		except AssertionError: pass
 	
 		if man:
@@ -307,28 +334,176 @@ class RomExtractor(object):
 	
 		return False
 
+# Extracts a single title; used by NandDump.scantickets.
+# title: (NandDump, id, name, channel type, True to record timings)
+# capture: collect the output instead of printing it
+# Returns (output, True if the ROM was extracted, timing records).
+def extract_title(title, capture=True):
+	nand, id, name, channeltype, timed = title
+	if capture:
+		stdout = sys.stdout
+		sys.stdout = StringIO()
+	recorder = None
+	if timed: recorder = timing.Recorder()
+	previous = timing.use(recorder)
+	
+	try:
+		print '%s: %s (ID: %s)' % (channeltype, name, id)
+		try:
+			with timing.stage('extract'):
+				extracted = RomExtractor(id, name, channeltype, nand).extract()
+		except Exception:
+			traceback.print_exc(file=sys.stdout)
+			extracted = False
+		print
+	finally:
+		timing.use(previous)
+		if capture:
+			log = sys.stdout.getvalue()
+			sys.stdout = stdout
+	
+	records = recorder and recorder.records or []
+	if capture: return log, extracted, records
+	else: return '', extracted, records
+
+# Sets up a worker process of scantickets.  The output of the workers is
+# captured and printed one title at a time, so progress is only reported by
+# sinks that don't write to the console.
+# cacheargs: arguments to decompcache.configure
+# progress_sink: name of the progress sink, as accepted by progress.sink_by_name
+def init_worker(cacheargs, progress_sink):
+	decompcache.configure(*cacheargs)
+	if progress_sink == 'console': progress_sink = 'none'
+	progress.configure(progress.sink_by_name(progress_sink))
+
+# languages of the channel titles in an IMET header, in order
+IMET_LANGUAGES = ('Japanese', 'English', 'German', 'French', 'Spanish', 'Italian',
+	'Dutch', 'Simplified Chinese', 'Traditional Chinese', 'Korean')
+IMET_NAMES_OFFSET = 0x1c # offset of the titles from the 'IMET' magic
+IMET_NAME_SIZE = 84 # 42 UTF-16BE characters
+IMET_SIZE = IMET_NAMES_OFFSET + len(IMET_LANGUAGES) * IMET_NAME_SIZE
+
+# The IMET header is normally at 0x40 or 0x80 in a banner app, so only the start
+# of the file is read; the rest is only searched if it isn't found there.
+IMET_SEARCH_SIZE = 0x1000
+
 class NandDump(object):
 	# path: path on filesystem to the extracted NAND dump
 	def __init__(self, path):
 		self.path = path + '/'
+		self.titles = {} # 00.app path -> (English title, {language: title})
 	
-	def scantickets(self):
-		tickets = os.listdir(os.path.join(self.path, 'ticket', '00010001'))
-		for ticket in tickets:
+	# Extracts every VC title in the NAND.
+	# jobs: number of titles to extract at once in separate processes; the
+	# output of each title is collected and printed in ticket order
+	# force: extract titles even if the manifest says they're unchanged
+	# report: if given, the path of a JSON file to write the time taken by each
+	# stage of each title's extraction to; a summary is also printed
+	# progress_sink: name of the progress sink used by the processes of --jobs
+	def scantickets(self, jobs=1, force=False, report=None, progress_sink='none'):
+		manifest = Manifest()
+		scanned = [] # (title, unchanged) in ticket order
+		titles = [] # the titles to extract
+		inputs = {}
+		reports = []
+		unchanged = 0
+		for ticket in self.tickets():
+			recorder = None
+			if report: recorder = timing.Recorder()
+			previous = timing.use(recorder)
+			try:
+				title = self.scanticket(ticket)
+				if title:
+					id, name, channeltype = title
+					with timing.stage('check manifest'):
+						inputs[id] = self.titleinputs(id, name, channeltype)
+						skip = not force and manifest.unchanged(id, inputs[id])
+			finally:
+				timing.use(previous)
+			if not title: continue
+			
+			reports.append({'id': id, 'name': name, 'type': channeltype,
+				'status': skip and 'unchanged' or 'failed',
+				'stages': recorder and recorder.records or []})
+			title = (self, id, name, channeltype, bool(report))
+			scanned.append((title, skip))
+			if skip: unchanged += 1
+			else: titles.append(title)
+		
+		pool = None
+		if jobs > 1:
+			import multiprocessing
+			# set up the same decompression cache and progress sink in the
+			# worker processes
+			cache = decompcache.cache
+			if cache: cacheargs = (cache.path, cache.max_size)
+			else: cacheargs = (None,)
+			pool = multiprocessing.Pool(jobs, init_worker, (cacheargs, progress_sink))
+			results = pool.imap(extract_title, titles)
+		else:
+			results = (extract_title(title, False) for title in titles)
+		
+		titlereports = dict((title['id'], title) for title in reports)
+		failed = []
+		try:
+			# results come in the order of titles, as each one finishes
+			for title, skip in scanned:
+				nand, id, name, channeltype, timed = title
+				if skip:
+					print '%s: %s (ID: %s)' % (channeltype, name, id)
+					print 'Unchanged since the last run'
+					print
+					continue
+				log, extracted, records = results.next()
+				sys.stdout.write(log)
+				titlereports[id]['stages'].extend(records)
+				if extracted:
+					titlereports[id]['status'] = 'extracted'
+					manifest.update(id, inputs[id], title_outputs(name))
+				else: failed.append(title)
+		finally:
+			if pool:
+				pool.terminate()
+				pool.join()
+			manifest.save()
+		
+		print '%d titles: %d extracted, %d unchanged, %d failed' % (len(titles) + unchanged,
+			len(titles) - len(failed), unchanged, len(failed))
+		for nand, id, name, channeltype, timed in failed:
+			print 'Failed: %s: %s (ID: %s)' % (channeltype, name, id)
+		
+		if report:
+			for title in reports:
+				title['wall'] = sum(record['wall'] for record in title['stages'] if record['depth'] == 0)
+				title['cpu'] = sum(record['cpu'] for record in title['stages'] if record['depth'] == 0)
+			f = open(report, 'wb')
+			# titles are Latin-1 byte strings, like in the manifest
+			json.dump({'titles': reports, 'stages': timing.aggregate(reports)}, f,
+				indent=1, sort_keys=True, separators=(',', ': '), encoding='latin-1')
+			f.close()
+			print
+			timing.print_summary(reports)
+	
+	# Returns the file names of the tickets of all channels in the NAND
+	def tickets(self):
+		return os.listdir(os.path.join(self.path, 'ticket', '00010001'))
+	
+	# Returns (id, name, channel type) for the title of a ticket, or None if
+	# it isn't a VC title
+	def scanticket(self, ticket):
+		with timing.stage('parse ticket'):
 			id = ticket.rstrip('.tik')
 			content = os.path.join('title', '00010001', id, 'content')
 			title = os.path.join(content, 'title.tmd')
 			if(os.path.exists(os.path.join(self.path, title))):
 				appname = self.getappname(title)
-				if not appname: continue
+				if not appname: return None
 				#print title, content + appname
 				name = self.gettitle(os.path.join(content, appname))
 				channeltype = self.channeltype(ticket)
 				if name and channeltype:
-					print '%s: %s (ID: %s)' % (channeltype, name, id)
-					ext = RomExtractor(id, name, channeltype, self)
-					ext.extract()
-					print
+					return id, name, channeltype
+			return None
 	
 	# Returns a string denoting the channel type.  Returns None if it's not a VC game.
 	def channeltype(self, ticket):
@@ -357,30 +532,94 @@ class NandDump(object):
 	# Returns the path to the 00.app file containing the game's title
 	# Precondition: the file denoted by "title" exists on the filesystem
 	def getappname(self, title):
+		appname = None
+		for cid, index, type, size, sha1 in self.getcontents(title):
+			if index == 0:
+				appname = '%08x.app' % cid
+		return appname
+	
+	# Returns the content records of a TMD as a list of
+	# [content ID, index, type, size, SHA-1 as a hex string]
+	# Precondition: the file denoted by "title" exists on the filesystem
+	def getcontents(self, title):
 		f = open(os.path.join(self.path, title), 'rb')
 		f.seek(0x1de)
 		count = struct.unpack('>H', f.read(2))[0]
 		f.seek(0x1e4)
-		appname = None
+		contents = []
 		for i in range(count):
 			info = struct.unpack('>IHHQ', f.read(16))
-			f.read(20)
-			if info[1] == 0:
-				appname = '%08x.app' % info[0]
-		return appname
+			contents.append(list(info) + [f.read(20).encode('hex')])
+		f.close()
+		return contents
+	
+	# Returns what a title's extraction depends on, for the manifest: its name
+	# and type, the content records in its TMD and the SHA-1 of each save file
+	def titleinputs(self, id, name, channeltype):
+		tmd = os.path.join('title', '00010001', id, 'content', 'title.tmd')
+		datadir = os.path.join(self.path, 'title', '00010001', id, 'data')
+		saves = {}
+		if os.path.isdir(datadir):
+			for filename in os.listdir(datadir):
+				path = os.path.join(datadir, filename)
+				if os.path.isfile(path): saves[filename] = sha1file(path)
+		return {'name': name, 'type': channeltype, 'contents': self.getcontents(tmd), 'saves': saves}
 	
 	# Gets title (in English) from a 00.app file
 	def gettitle(self, path):
-		path = os.path.join(self.path, path)
+		return self.readtitles(path)[0]
+	
+	# Gets the titles in every language from a 00.app file, as a dictionary
+	# mapping language names to unicode strings.  Empty titles are left out.
+	def gettitles(self, path):
+		return self.readtitles(path)[1]
+	
+	# Returns (English title, titles in every language) for a 00.app file,
+	# reading its IMET header on first use.  Both are None if the file doesn't
+	# exist or has no IMET header.
+	def readtitles(self, path):
+		if path not in self.titles:
+			imet = self.readimet(os.path.join(self.path, path))
+			if imet is None:
+				self.titles[path] = (None, None)
+			else:
+				english = IMET_NAMES_OFFSET + IMET_LANGUAGES.index('English') * IMET_NAME_SIZE
+				titles = {}
+				for i, language in enumerate(IMET_LANGUAGES):
+					start = IMET_NAMES_OFFSET + i * IMET_NAME_SIZE
+					title = imet[start:start+IMET_NAME_SIZE].decode('utf-16-be').rstrip(u'\0')
+					title = u' - '.join(line for line in title.split(u'\0') if line)
+					if title: titles[language] = title
+				# the English title is formatted from the low bytes of its
+				# characters, as it always has been
+				self.titles[path] = (self.formattitle(imet[english+1:english+1+IMET_NAME_SIZE]), titles)
+		return self.titles[path]
+	
+	# Returns the IMET header of a banner app, or None if it doesn't have one.
+	# Only the start of the file is read unless the header isn't there.
+	def readimet(self, path):
 		if not os.path.exists(path): return None
 		f = open(path, 'rb')
-		data = f.read()
-		f.close()
-		index = data.find('IMET')
-		if index < 0: return None
-		engindex = index + 29 + 84
-		title = data[engindex:engindex+84]
-		
+		try:
+			data = f.read(IMET_SEARCH_SIZE)
+			index = data.find('IMET')
+			if index < 0:
+				if len(data) < IMET_SEARCH_SIZE: return None
+				# search the rest of the file without reading it into memory
+				m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+				try: index = m.find('IMET', IMET_SEARCH_SIZE - 3)
+				finally: m.close()
+				if index < 0: return None
+			if index + IMET_SIZE > len(data):
+				f.seek(index)
+				data = f.read(IMET_SIZE)
+				index = 0
+			return data[index:index+IMET_SIZE].ljust(IMET_SIZE, '\0')
+		finally:
+			f.close()
+	
+	# Formats a title read from the low bytes of its UTF-16 characters
+	def formattitle(self, title):
 		# Format the title properly
 		title = title.strip('\0')
 		while title.find('\0\0\0') >= 0: title = title.replace('\0\0\0', '\0\0')
@@ -391,8 +630,29 @@ class NandDump(object):
 		return title
 
 if __name__ == '__main__':
-	import sys
-	nand = NandDump(sys.argv[1])
-	nand.scantickets()
-	if len(sys.argv) >= 3: print nand.gettitle(sys.argv[2])
+	from optparse import OptionParser
+	parser = OptionParser(usage='%prog [options] nand_directory [title_app]')
+	parser.add_option('-j', '--jobs', type='int', default=1,
+		help='number of titles to extract in parallel (default: 1)')
+	parser.add_option('-f', '--force', action='store_true', default=False,
+		help='extract every title, even if it is unchanged since the last run')
+	parser.add_option('--cache-dir', default=decompcache.DEFAULT_PATH,
+		help='directory for caching decompressed files (default: %default)')
+	parser.add_option('--cache-size', type='int', default=decompcache.DEFAULT_MAX_SIZE / (1024 * 1024),
+		help='size limit of the decompression cache in MB (default: %default)')
+	parser.add_option('--no-cache', action='store_true', default=False,
+		help='do not use the decompression cache')
+	parser.add_option('--progress', choices=('console', 'json', 'none'), default='console',
+		help='how to report the progress of long operations: console, json (JSON lines on stderr) or none (default: %default)')
+	parser.add_option('--timing', metavar='FILE',
+		help='write the time taken by each stage of each extraction to FILE as JSON, and print the slowest titles and stages')
+	options, args = parser.parse_args()
+	if not args: parser.error('no NAND directory given')
+	
+	if not options.no_cache:
+		decompcache.configure(options.cache_dir, options.cache_size * 1024 * 1024)
+	progress.configure(progress.sink_by_name(options.progress))
+	nand = NandDump(args[0])
+	nand.scantickets(options.jobs, options.force, options.timing, options.progress)
+	if len(args) >= 2: print nand.gettitle(args[1])
 